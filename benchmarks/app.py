@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import tempfile
+
+# makes imports relative from the repo directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tremolo import Application  # noqa: E402
+from tremolo.exceptions import Forbidden  # noqa: E402
+from tremolo_login import (  # noqa: E402
+    Session,
+    FileStore,
+    MemoryStore,
+    TieredStore,
+    SocketStore
+)
+from tremolo_login import daemon  # noqa: E402
+
+HTTP_HOST = '127.0.0.1'
+HTTP_PORT = 28080
+
+# the size of the dummy payload stored on login, in bytes
+PAYLOAD_SIZE = int(os.environ.get('BENCH_PAYLOAD_SIZE', 0))
+CONNECTION_CACHE = os.environ.get('BENCH_CONNECTION_CACHE') == '1'
+STORE = os.environ.get('BENCH_STORE', 'file')
+SOCKET_PATH = os.path.join(tempfile.gettempdir(), 'bench-sess.sock')
+
+
+def get_store(name):
+    if name == 'file':
+        return
+
+    path = os.path.join(tempfile.gettempdir(), 'bench-sess')
+
+    if name == 'tiered':
+        return TieredStore(MemoryStore(), FileStore(path))
+
+    if name == 'tiered-write-back':
+        return TieredStore(MemoryStore(), FileStore(path),
+                           write_policy='write-back')
+
+    if name == 'socket':
+        return SocketStore(SOCKET_PATH)
+
+    raise ValueError('unknown store: %s' % name)
+
+
+app = Application()
+
+# session middleware
+sess = Session(app, path='bench', expires=1800,
+               connection_cache=CONNECTION_CACHE, store=get_store(STORE))
+
+
+@app.route('/')
+async def index(request, **_):
+    return b'OK'
+
+
+@app.route('/login')
+async def login(request, **_):
+    session = request.ctx.session
+
+    form_data = await request.form()
+
+    if session is None or form_data.get('password') != ['mypass']:
+        raise Forbidden
+
+    if PAYLOAD_SIZE:
+        session['payload'] = 'x' * PAYLOAD_SIZE
+
+    # the token can be used as `Authorization: sess <token>`
+    return session.login()
+
+
+@app.route('/page')
+async def page(request, **_):
+    if request.ctx.session.is_logged_in():
+        return b'Welcome to Dashboard.'
+
+    raise Forbidden
+
+
+@app.route('/api')
+async def api(request, **_):
+    if request.ctx.session.is_logged_in():
+        return b'{"ok": true}', 'utf-8'
+
+    raise Forbidden
+
+
+@app.route('/logout')
+async def logout(request, **_):
+    request.ctx.session.logout()
+    return b'OK'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='The Tremolo app targeted by the load generator.'
+    )
+    parser.add_argument('--host', default=HTTP_HOST)
+    parser.add_argument('--port', type=int, default=HTTP_PORT)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--payload', type=int, default=PAYLOAD_SIZE,
+                        help='dummy payload size stored on login, in bytes')
+    parser.add_argument('--connection-cache', action='store_true',
+                        help='enable the connection-scoped session cache')
+    parser.add_argument('--store', default=STORE,
+                        choices=('file', 'tiered', 'tiered-write-back',
+                                 'socket'))
+    args = parser.parse_args()
+
+    # workers are spawned, they read them from the environment
+    os.environ['BENCH_PAYLOAD_SIZE'] = str(args.payload)
+    os.environ['BENCH_CONNECTION_CACHE'] = str(int(args.connection_cache))
+    os.environ['BENCH_STORE'] = args.store
+
+    if args.store == 'socket':
+        server = daemon.spawn(SOCKET_PATH)
+    else:
+        server = None
+
+    try:
+        app.run(args.host, port=args.port, worker_num=args.workers,
+                log_level='ERROR')
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from base64 import urlsafe_b64encode as b64encode
+
+# makes imports relative from the repo directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tremolo_login import (  # noqa: E402
+    FileStore,
+    MemoryStore,
+    TieredStore,
+    SocketStore
+)
+from tremolo_login import daemon  # noqa: E402
+
+STORES = ('memory', 'file', 'tiered', 'socket')
+SOCKET_PATH = os.path.join(tempfile.gettempdir(), 'bench-batch.sock')
+
+
+def make_id():
+    # never expires
+    return b64encode(b'\xff\xff\xff\xff' + os.urandom(44)).decode('latin-1')
+
+
+def get_store(name, path, max_workers):
+    if name == 'memory':
+        return MemoryStore(maxsize=10000000)
+
+    if name == 'file':
+        return FileStore(path, max_workers=max_workers)
+
+    if name == 'tiered':
+        # cold L1, so the reads go to L2
+        return TieredStore(MemoryStore(maxsize=1),
+                           FileStore(path, max_workers=max_workers))
+
+    if name == 'socket':
+        return SocketStore(SOCKET_PATH)
+
+    raise ValueError('unknown store: %s' % name)
+
+
+def timeit(func, *args):
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+
+def measure(store, n, payload):
+    items = {make_id(): {'payload': 'x' * payload} for _ in range(n)}
+    ids = list(items)
+
+    def set_loop():
+        for session_id, data in items.items():
+            store.set(session_id, data)
+
+    def get_loop():
+        for session_id in ids:
+            store.get(session_id)
+
+    def delete_loop():
+        for session_id in ids:
+            store.delete(session_id)
+
+    result = {}
+
+    # the loops first, so both runs find the same sessions
+    for op, per_item, batched, arg in (
+            ('set', set_loop, store.set_many, items),
+            ('get', get_loop, store.get_many, ids),
+            ('delete', delete_loop, store.delete_many, ids)):
+        if op == 'delete':
+            store.set_many(items)
+
+        result[op] = {'loop': timeit(per_item)}
+
+        if op == 'delete':
+            store.set_many(items)
+
+        result[op]['batch'] = timeit(batched, arg)
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares get_many(), set_many() and delete_many() '
+                    'with per-session loops.'
+    )
+    parser.add_argument('--stores', default=','.join(STORES),
+                        help='default: %s' % ','.join(STORES))
+    parser.add_argument('-n', '--sessions', type=int, default=10000)
+    parser.add_argument('--payload', type=int, default=256,
+                        help='payload size in bytes, default: 256')
+    parser.add_argument('--max-workers', type=int, default=8,
+                        help='threads of the file store, default: 8')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    stores = [v for v in args.stores.split(',') if v]
+
+    for name in stores:
+        if name not in STORES:
+            parser.error('unknown store: %s' % name)
+
+    if 'socket' in stores:
+        server = daemon.spawn(SOCKET_PATH)
+        time.sleep(1)
+    else:
+        server = None
+
+    path = tempfile.mkdtemp(prefix='bench-batch-')
+    loop = asyncio.new_event_loop()
+    results = {}
+
+    try:
+        for name in stores:
+            store = get_store(name, path, args.max_workers)
+
+            try:
+                results[name] = measure(store, args.sessions, args.payload)
+            finally:
+                if hasattr(store, 'stop'):
+                    loop.run_until_complete(store.stop())
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+        loop.close()
+
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print('%d sessions, payload %d' % (args.sessions, args.payload))
+    print('%-8s %-7s %10s %10s %8s' % ('store', 'op', 'loop', 'batch',
+                                       'speedup'))
+
+    for name, result in results.items():
+        for op, item in result.items():
+            print('%-8s %-7s %9.1fms %9.1fms %7.1fx' % (
+                name, op, item['loop'] * 1000, item['batch'] * 1000,
+                item['loop'] / item['batch'] if item['batch'] else 0)
+            )
+
+
+if __name__ == '__main__':
+    main()
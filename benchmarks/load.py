@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess  # nosec B404
+import sys
+import time
+
+# makes imports relative from the repo directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.app import HTTP_HOST, HTTP_PORT  # noqa: E402
+from tests.netizen import HTTPClient  # noqa: E402
+
+ACTIONS = ('anon', 'login', 'page', 'api', 'logout')
+DEFAULT_MIX = 'anon=2,login=1,page=10,api=10,logout=1'
+
+
+def parse_mix(value):
+    mix = {}
+
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+
+        if name not in ACTIONS:
+            raise ValueError('unknown action: %s' % name)
+
+        mix[name] = float(weight or 1)
+
+    return mix
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+
+    # nearest-rank, values must be sorted
+    return values[max(int(len(values) * p / 100 + 0.5), 1) - 1]
+
+
+class Stats:
+    def __init__(self, names=ACTIONS):
+        self.names = names
+        self.latencies = {name: [] for name in names}
+        self.errors = {name: 0 for name in names}
+        self.started = time.perf_counter()
+        self.stopped = None
+
+    def add(self, name, latency):
+        self.latencies[name].append(latency)
+
+    def error(self, name):
+        self.errors[name] += 1
+
+    def report(self):
+        elapsed = (self.stopped or time.perf_counter()) - self.started
+        result = {'elapsed': elapsed, 'actions': {}}
+        total = []
+
+        for name in self.names:
+            values = sorted(self.latencies[name])
+            total.extend(values)
+
+            if values or self.errors[name]:
+                result['actions'][name] = self._summary(values, elapsed,
+                                                        self.errors[name])
+
+        total.sort()
+        result['total'] = self._summary(total, elapsed,
+                                        sum(self.errors.values()))
+
+        return result
+
+    def _summary(self, values, elapsed, errors):
+        return {
+            'requests': len(values),
+            'errors': errors,
+            'rps': len(values) / elapsed if elapsed else 0.0,
+            'p50': percentile(values, 50) * 1000,
+            'p95': percentile(values, 95) * 1000,
+            'p99': percentile(values, 99) * 1000
+        }
+
+
+class User:
+    """A virtual user driving one client connection."""
+
+    def __init__(self, args, stats):
+        self.args = args
+        self.stats = stats
+        self.client = HTTPClient(args.host, args.port, timeout=args.timeout)
+        self.token = None
+        self.connected = False
+
+    async def connect(self):
+        await self.client.__aenter__()
+        self.connected = True
+
+    def close(self):
+        if self.connected:
+            self.client.close()
+            self.connected = False
+
+    async def request(self, name, line, *args, body=b'', status=200):
+        if not self.args.keepalive:
+            args += (b'Connection: close',)
+
+        if body:
+            args += (b'Content-Type: application/x-www-form-urlencoded',
+                     b'Content-Length: %d' % len(body))
+
+        try:
+            # e.g. refused while the server is overloaded, counted as well
+            if not self.connected:
+                await self.connect()
+
+            started = time.perf_counter()
+            response = await self.client.send(line, *args, body=body)
+            if response.header is None:
+                raise ConnectionResetError('connection closed unexpectedly')
+
+            data = await response.body()
+        except (OSError, ValueError, StopAsyncIteration):
+            self.stats.error(name)
+            self.close()
+            return
+
+        self.stats.add(name, time.perf_counter() - started)
+
+        if (not self.args.keepalive or
+                response.headers.get(b'connection') == [b'close']):
+            self.close()
+
+        if response.status != status:
+            self.stats.error(name)
+            return
+
+        return data
+
+    async def anon(self):
+        # forget the cookie, behave like a first-time visitor
+        del self.client.headers[3:]
+        self.token = None
+
+        await self.request('anon', b'GET / HTTP/1.1')
+
+    async def login(self):
+        if len(self.client.headers) == 3:
+            # no cookie yet, the session is established on the first visit
+            await self.anon()
+
+        data = await self.request('login', b'POST /login HTTP/1.1',
+                                  body=b'password=mypass')
+
+        if data:
+            self.token = bytes(data)
+
+    async def page(self):
+        if self.token is None:
+            await self.login()
+
+            if self.token is None:
+                return
+
+        await self.request('page', b'GET /page HTTP/1.1')
+
+    async def api(self):
+        if self.token is None:
+            await self.login()
+
+            if self.token is None:
+                return
+
+        await self.request('api', b'GET /api HTTP/1.1',
+                           b'Authorization: sess %s' % self.token)
+
+    async def logout(self):
+        if self.token is None:
+            await self.login()
+
+            if self.token is None:
+                return
+
+        await self.request('logout', b'GET /logout HTTP/1.1')
+        self.token = None
+
+    async def run(self, mix, deadline):
+        names = list(mix)
+        weights = [mix[name] for name in names]
+
+        try:
+            while time.perf_counter() < deadline:
+                name, = random.choices(names, weights)  # nosec B311
+                await getattr(self, name)()
+        finally:
+            self.close()
+
+
+async def run(args):
+    stats = Stats()
+    deadline = stats.started + args.duration
+    mix = parse_mix(args.mix)
+    users = [User(args, stats) for _ in range(args.concurrency)]
+
+    await asyncio.gather(*(user.run(mix, deadline) for user in users))
+    stats.stopped = time.perf_counter()
+
+    return stats.report()
+
+
+def print_report(result, args):
+    print('%d users, %s, %.2fs' % (
+        args.concurrency,
+        'keep-alive' if args.keepalive else 'no keep-alive',
+        result['elapsed'])
+    )
+    print_table(result)
+
+
+def print_table(result):
+    print('%-8s %10s %8s %10s %9s %9s %9s' % (
+        'action', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')
+    )
+
+    for name, item in list(result['actions'].items()) + [
+            ('total', result['total'])]:
+        print('%-8s %10d %8d %10.1f %9.2f %9.2f %9.2f' % (
+            name, item['requests'], item['errors'], item['rps'],
+            item['p50'], item['p95'], item['p99'])
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='A concurrent HTTP load generator for login/session '
+                    'workloads.'
+    )
+    parser.add_argument('--host', default=HTTP_HOST)
+    parser.add_argument('--port', type=int, default=HTTP_PORT)
+    parser.add_argument('--spawn', action='store_true',
+                        help='start benchmarks.app before generating load')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of server workers, with --spawn')
+    parser.add_argument('--payload', type=int, default=0,
+                        help='session payload size in bytes, with --spawn')
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('-d', '--duration', type=float, default=10)
+    parser.add_argument('--no-keepalive', dest='keepalive',
+                        action='store_false')
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='weighted actions, default: %s' % DEFAULT_MIX)
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    # the unknown arguments are passed to benchmarks.app, with --spawn
+    args, app_args = parser.parse_known_args()
+
+    if args.spawn:
+        server = subprocess.Popen([  # nosec B603
+            sys.executable, '-m', 'benchmarks.app',
+            '--host', args.host, '--port', str(args.port),
+            '--workers', str(args.workers), '--payload', str(args.payload),
+            *app_args
+        ], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        time.sleep(2)
+    else:
+        server = None
+
+    loop = asyncio.new_event_loop()
+
+    try:
+        result = loop.run_until_complete(run(args))
+    finally:
+        loop.close()
+
+        if server is not None:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result, args)
+
+
+if __name__ == '__main__':
+    main()
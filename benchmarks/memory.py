@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+from base64 import urlsafe_b64encode as b64encode
+
+# makes imports relative from the repo directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tremolo import Application  # noqa: E402
+from tremolo_login import Session, MemoryStore  # noqa: E402
+from tremolo_login import LazySessionData, SessionData  # noqa: E402
+from tremolo_login.daemon import SessionServer, OP_SET  # noqa: E402
+
+TARGETS = ('memory-store', 'daemon', 'session-data', 'lazy-session-data')
+
+
+def make_id(i):
+    # unique and never expires
+    return b64encode(
+        b'\xff\xff\xff\xff' + i.to_bytes(44, byteorder='big')
+    ).decode('latin-1')
+
+
+def make_session(i, payload):
+    # a distinct payload string per session, like in the real world
+    return {'sid': '%064d' % i, 'payload': ('%d' % i).rjust(payload, 'x')}
+
+
+class Request:
+    headers = {}
+
+
+def build(target, n, payload):
+    """Creates ``n`` sessions and returns what holds them."""
+    if target == 'memory-store':
+        store = MemoryStore(maxsize=n)
+
+        for i in range(n):
+            store.set(make_id(i), make_session(i, payload))
+
+        return store
+
+    if target == 'daemon':
+        server = SessionServer(None, maxsize=n)
+
+        for i in range(n):
+            server.execute(OP_SET, make_id(i),
+                           json.dumps(make_session(i, payload)).encode())
+
+        return server
+
+    # SessionData is created for each request in flight
+    sess = Session(Application(), store=MemoryStore())
+    request = Request()
+
+    if target == 'session-data':
+        return [SessionData(sess, make_id(i), None, make_session(i, payload),
+                            None, request) for i in range(n)]
+
+    if target == 'lazy-session-data':
+        return [LazySessionData(sess, make_id(i), None, {'sid': '%064d' % i},
+                                None, request) for i in range(n)]
+
+    raise ValueError('unknown target: %s' % target)
+
+
+def measure(target, n, payload):
+    gc.collect()
+    tracemalloc.start()
+
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        obj = build(target, n, payload)
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    del obj
+
+    return {
+        'target': target,
+        'sessions': n,
+        'payload': payload,
+        'bytes': current - before,
+        'bytes_per_session': (current - before) / n,
+        'peak': peak - before
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns the results whose ``bytes_per_session`` grew by more than
+    ``tolerance`` (a fraction) over the baseline.
+    """
+    expected = {(item['target'], item['sessions'], item['payload']):
+                item['bytes_per_session'] for item in baseline}
+    regressions = []
+
+    for item in results:
+        key = (item['target'], item['sessions'], item['payload'])
+
+        if (key in expected and
+                item['bytes_per_session'] > expected[key] * (1 + tolerance)):
+            regressions.append(dict(item, baseline=expected[key]))
+
+    return regressions
+
+
+def parse_list(value, type=int):
+    return [type(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measures the memory per session with tracemalloc.'
+    )
+    parser.add_argument('--counts', default='10000,100000,1000000',
+                        help='numbers of sessions, comma-separated')
+    parser.add_argument('--payloads', default='0,256,4096',
+                        help='payload sizes in bytes, comma-separated')
+    parser.add_argument('--targets', default=','.join(TARGETS),
+                        help='default: %s' % ','.join(TARGETS))
+    parser.add_argument('--baseline',
+                        help='a previous --json output to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed growth over the baseline, default: 0.1')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = []
+
+    if not args.json:
+        print('%-18s %9s %7s %14s %10s %14s' % (
+            'target', 'sessions', 'payload', 'bytes', 'per sess', 'peak')
+        )
+
+    for target in parse_list(args.targets, str):
+        if target not in TARGETS:
+            parser.error('unknown target: %s' % target)
+
+        for n in parse_list(args.counts):
+            for payload in parse_list(args.payloads):
+                results.append(measure(target, n, payload))
+
+                if not args.json:
+                    item = results[-1]
+                    print('%-18s %9d %7d %14d %10.1f %14d' % (
+                        target, n, payload, item['bytes'],
+                        item['bytes_per_session'], item['peak'])
+                    )
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+
+        for item in regressions:
+            print('regression: %s, %d sessions, payload %d: %.1f > %.1f '
+                  'bytes per session' % (
+                      item['target'], item['sessions'], item['payload'],
+                      item['bytes_per_session'], item['baseline']),
+                  file=sys.stderr)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from base64 import urlsafe_b64encode as b64encode
+from concurrent.futures import ThreadPoolExecutor
+
+# makes imports relative from the repo directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tremolo import Application  # noqa: E402
+from tremolo.exceptions import Forbidden  # noqa: E402
+from tremolo.lib.contexts import (  # noqa: E402
+    Context,
+    ConnectionContext,
+    RequestContext
+)
+
+from benchmarks.app import SOCKET_PATH, get_store  # noqa: E402
+from benchmarks.load import Stats, print_table  # noqa: E402
+from tremolo_login import Session, daemon  # noqa: E402
+from tremolo_login.recorder import read_trace  # noqa: E402
+
+# what the timings are grouped by
+KINDS = ('miss', 'anon', 'cookie', 'auth')
+
+
+class Executor:
+    """Adapts a thread pool to the ``submit(func, args)`` of Tremolo."""
+
+    def __init__(self, loop, max_workers):
+        self.loop = loop
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, func, args=(), kwargs={}):
+        return self.loop.run_in_executor(
+            self.pool, lambda: func(*args, **kwargs)
+        )
+
+
+class Request:
+    def __init__(self, path, headers, cookies):
+        self.path = path
+        self.headers = headers
+        self.cookies = cookies
+        self.ctx = RequestContext()
+
+    def uid(self, length=32, *, ts_offset=0):
+        return (int(time.time()) + ts_offset).to_bytes(
+            4, byteorder='big') + os.urandom(length - 4)
+
+
+class Response:
+    def __init__(self):
+        self.headers = {}
+
+    def set_header(self, name, value):
+        self.headers.setdefault(name.lower(), []).append(value)
+
+    def set_cookie(self, name, value, **kwargs):
+        self.set_header(b'set-cookie', ('%s=%s' % (name, value)).encode())
+
+
+def make_id(expires=1800):
+    return b64encode(
+        (int(time.time()) + expires).to_bytes(4, byteorder='big') +
+        os.urandom(44)
+    ).decode('latin-1')
+
+
+def get_kind(record):
+    if not record['match']:
+        return 'miss'
+
+    if record['new'] or record['auth'] is None:
+        return 'anon'
+
+    if record['auth'] == 'authorization':
+        return 'auth'
+
+    return 'cookie'
+
+
+class Replay:
+    """Maps the hashed ids in the trace to real sessions of the same size,
+    then sends the recorded requests through the session middleware.
+    """
+
+    def __init__(self, sess, records):
+        self.sess = sess
+        self.records = records
+        self.ids = {}
+        self.contexts = {}
+
+    def seed(self):
+        for record in self.records:
+            if (record['id'] is None or record['id'] in self.ids or
+                    record['new'] or not record['match']):
+                continue
+
+            session_id = make_id(self.sess.expires)
+            data = {'sid': 'x' * 64} if record['auth'] == 'authorization' \
+                else {}
+            # about the recorded size, as JSON
+            data['payload'] = 'x' * max(record['read'] - 50, 0)
+
+            self.sess.store.set(session_id, data)
+            self.ids[record['id']] = session_id
+
+        return len(self.ids)
+
+    def make_request(self, record):
+        path = record['path'].encode('latin-1')
+        session_id = self.ids.get(record['id'])
+
+        if record['new'] or session_id is None:
+            return Request(path, {}, {})
+
+        if record['auth'] == 'authorization':
+            return Request(path, {b'authorization': [
+                ('%s %s%s' % (self.sess.name, session_id,
+                              'x' * 64)).encode('latin-1')
+            ]}, {})
+
+        return Request(path, {}, {self.sess.name: [session_id]})
+
+    async def send(self, record, server):
+        request = self.make_request(record)
+        server['context'] = self.contexts.setdefault(record['id'],
+                                                     ConnectionContext())
+
+        await self.sess._on_request(request, Response(), **server)
+        session = request.ctx.session
+
+        if session is not None and record['written'] > 0:
+            session['replay'] = 'x' * record['written']
+
+        await self.sess._on_response(request, **server)
+
+    async def run(self, concurrency, executor):
+        stats = Stats(KINDS)
+        server = {'globals': Context(executor=executor)}
+        records = iter(self.records)
+
+        async def worker():
+            for record in records:
+                kind = get_kind(record)
+                started = time.perf_counter()
+
+                try:
+                    await self.send(record, dict(server))
+                except Forbidden:
+                    stats.error(kind)
+                else:
+                    stats.add(kind, time.perf_counter() - started)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        stats.stopped = time.perf_counter()
+
+        return stats.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replays a trace recorded by TraceRecorder '
+                    'through the session middleware.'
+    )
+    parser.add_argument('trace')
+    parser.add_argument('--store', default='file',
+                        choices=('file', 'tiered', 'tiered-write-back',
+                                 'socket'))
+    parser.add_argument('--paths', default='',
+                        help='comma-separated url path prefixes')
+    parser.add_argument('--connection-cache', action='store_true')
+    parser.add_argument('--lazy-load', action='store_true')
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=8,
+                        help='executor threads for the blocking stores')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    records = list(read_trace(args.trace)) * args.repeat
+
+    if args.store == 'socket':
+        server = daemon.spawn(SOCKET_PATH)
+        time.sleep(1)
+    else:
+        server = None
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    executor = Executor(loop, args.threads)
+
+    sess = Session(Application(), path='bench-replay',
+                   paths=[v for v in args.paths.split(',') if v],
+                   connection_cache=args.connection_cache,
+                   store=get_store(args.store), lazy_load=args.lazy_load)
+    replay = Replay(sess, records)
+
+    try:
+        if hasattr(sess.store, 'start'):
+            loop.run_until_complete(sess.store.start(loop=loop))
+
+        seeded = replay.seed()
+        result = loop.run_until_complete(
+            replay.run(args.concurrency, executor)
+        )
+        result['seeded'] = seeded
+    finally:
+        for session_id in replay.ids.values():
+            sess.store.delete(session_id)
+
+        if hasattr(sess.store, 'stop'):
+            loop.run_until_complete(sess.store.stop())
+
+        executor.pool.shutdown()
+        loop.close()
+
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print('%d records, %d sessions, %s store, %.2fs' % (
+            len(records), result['seeded'], args.store, result['elapsed'])
+        )
+        print_table(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import os
+import pickle
+import shutil
+import sys
+import unittest
+
+from base64 import urlsafe_b64encode as b64encode
+from unittest import mock
+
+# makes imports relative from the repo directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tremolo import Application  # noqa: E402
+from tremolo.lib.contexts import (  # noqa: E402
+    Context,
+    ConnectionContext,
+    RequestContext
+)
+from tremolo_login import (  # noqa: E402
+    AuditLog,
+    BoundedStore,
+    FileStore,
+    MemoryStore,
+    Session,
+    SessionRouter,
+    SocketStore,
+    SlowLog,
+    TieredStore,
+    TraceRecorder
+)
+from tremolo_login.recorder import read_trace  # noqa: E402
+
+SESSION_ID = b64encode(b'\xff\xff\xff\xff_session_id').decode('latin-1')
+
+
+class Executor:
+    """Runs the submitted functions one loop iteration later."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.calls = 0
+
+    def submit(self, func, args=(), kwargs={}):
+        self.calls += 1
+        fut = self.loop.create_future()
+
+        self.loop.call_soon(
+            lambda: fut.done() or fut.set_result(func(*args, **kwargs))
+        )
+        return fut
+
+
+class Request:
+    def __init__(self, path=b'/', cookies={}):
+        self.path = path
+        self.headers = {}
+        self.cookies = cookies
+        self.ctx = RequestContext()
+
+    def uid(self, length=32, *, ts_offset=0):
+        return (0xffffffff).to_bytes(4, byteorder='big') + os.urandom(
+            length - 4
+        )
+
+
+class Response:
+    def __init__(self):
+        self.headers = {}
+
+    def set_header(self, name, value):
+        self.headers.setdefault(name.lower(), []).append(value)
+
+    def set_cookie(self, name, value, **kwargs):
+        self.set_header(b'set-cookie', ('%s=%s' % (name, value)).encode())
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        print('\r\n[', self.id(), ']')
+
+        self.loop = asyncio.new_event_loop()
+        self.sess = Session(Application(), path='test-session')
+        self.filepath = os.path.join(self.sess.path, SESSION_ID)
+
+        with open(self.filepath, 'w') as fp:
+            json.dump({'foo': 'bar'}, fp)
+
+    def tearDown(self):
+        self.loop.close()
+
+        if os.path.exists(self.filepath):
+            os.unlink(self.filepath)
+
+    def test_load_single_flight(self):
+        executor = Executor(self.loop)
+
+        async def load_concurrently():
+            return await asyncio.gather(*(
+                self.sess._load(SESSION_ID, executor) for _ in range(10)
+            ))
+
+        results = self.loop.run_until_complete(load_concurrently())
+
+        self.assertEqual(executor.calls, 1)
+        self.assertEqual(results, [{'foo': 'bar'}] * 10)
+        self.assertEqual(self.sess._loading, {})
+
+        # each one gets its own
+        self.assertEqual(len(set(map(id, results))), 10)
+
+        # the next load after completion reads the store again
+        self.loop.run_until_complete(
+            self.sess._load(SESSION_ID, executor)
+        )
+        self.assertEqual(executor.calls, 2)
+
+    def test_connection_cache(self):
+        sess = Session(Application(), path='test-session',
+                       connection_cache=True)
+        context = ConnectionContext()
+        executor = Executor(self.loop)
+
+        def send():
+            request = Request(cookies={'sess': [SESSION_ID]})
+
+            self.loop.run_until_complete(sess._on_request(
+                request, Response(), context=context,
+                globals=Context(executor=executor)
+            ))
+            return request
+
+        self.assertEqual(send().ctx.session, {'foo': 'bar'})
+        self.assertEqual(executor.calls, 1)
+
+        # keep-alive request, served from the connection cache
+        request = send()
+        self.assertEqual(request.ctx.session, {'foo': 'bar'})
+        self.assertEqual(executor.calls, 1)
+
+        request.ctx.session['baz'] = 'qux'
+        self.loop.run_until_complete(
+            sess._on_response(request, context=context)
+        )
+
+        # its own save does not invalidate the cache
+        self.assertEqual(send().ctx.session, {'foo': 'bar', 'baz': 'qux'})
+        self.assertEqual(executor.calls, 1)
+
+        # modified elsewhere, e.g. by another worker
+        with open(self.filepath, 'w') as fp:
+            json.dump({'foo': 'baz'}, fp)
+
+        self.assertEqual(send().ctx.session, {'foo': 'baz'})
+        self.assertEqual(executor.calls, 2)
+
+        # changed in place, without saving, the cached one is left as is
+        request = send()
+        request.ctx.session['cart'] = []
+        self.loop.run_until_complete(
+            sess._on_response(request, context=context)
+        )
+
+        send().ctx.session['cart'].append('item')
+        self.assertEqual(send().ctx.session, {'foo': 'baz', 'cart': []})
+
+    def test_lazy_load(self):
+        sess = Session(Application(), path='test-session', lazy_load=True)
+        sid = 'x' * 64
+
+        with open(self.filepath, 'w') as fp:
+            fp.write(sid + '\n')
+            json.dump({'foo': 'bar'}, fp)
+
+        request = Request(cookies={'sess': [SESSION_ID]})
+        self.loop.run_until_complete(sess._on_request(request, Response()))
+        session = request.ctx.session
+
+        self.assertFalse(session._loaded)
+        self.assertEqual(session.get('sid'), sid)
+        self.assertFalse(session._loaded)
+
+        # unchanged, nothing is loaded or written
+        session.save()
+        self.assertFalse(session.modified)
+
+        self.assertEqual(session['foo'], 'bar')
+        self.assertTrue(session._loaded)
+        self.assertEqual(session, {'sid': sid, 'foo': 'bar'})
+
+        session.logout()
+        self.assertEqual(sess.store.get_auth(SESSION_ID), {})
+        self.assertEqual(sess.store.get(SESSION_ID), {'foo': 'bar'})
+
+        with open(self.filepath) as fp:
+            self.assertEqual(fp.read(), '\n{"foo": "bar"}')
+
+    def test_slow_log(self):
+        sess = Session(Application(), path='test-session',
+                       slow_log=SlowLog(threshold=0, stack=True))
+        request = Request(cookies={'sess': [SESSION_ID]})
+
+        with self.assertLogs('tremolo_login', level='WARNING') as cm:
+            self.loop.run_until_complete(
+                sess._on_request(request, Response())
+            )
+            request.ctx.session['baz'] = 'qux'
+            self.loop.run_until_complete(sess._on_response(request))
+
+        self.assertEqual(len(cm.output), 3)
+        self.assertTrue(cm.output[0].startswith(
+            'WARNING:tremolo_login:slow session request: '
+        ))
+        self.assertIn('id=%s...,' % SESSION_ID[:8], cm.output[0])
+        self.assertIn('size=14, phases=match:', cm.output[0])
+        self.assertNotIn(SESSION_ID, '\n'.join(cm.output))
+        self.assertIn('slow session save: ', cm.output[1])
+        self.assertIn('phases=copy:', cm.output[1])
+        self.assertIn('slow session response: ', cm.output[2])
+        self.assertIn('in test_slow_log', cm.output[2])
+
+    def test_defer_id(self):
+        sess = Session(Application(), path='test-session', defer_id=True)
+
+        def send():
+            request = Request()
+            response = Response()
+            self.loop.run_until_complete(sess._on_request(request, response))
+            return request, response
+
+        # nothing is written
+        request, response = send()
+        self.assertIsNone(request.ctx.session.id)
+        self.assertFalse(request.ctx.session.is_logged_in())
+        self.loop.run_until_complete(sess._on_response(request))
+        self.assertIsNone(request.ctx.session.id)
+        self.assertNotIn(b'set-cookie', response.headers)
+
+        request, response = send()
+        request.ctx.session['foo'] = 'baz'
+        self.loop.run_until_complete(sess._on_response(request))
+        session_id = request.ctx.session.id
+
+        try:
+            self.assertEqual(response.headers[b'set-cookie'],
+                             [('sess=%s' % session_id).encode()])
+            self.assertEqual(sess.store.get(session_id), {'foo': 'baz'})
+        finally:
+            sess.store.delete(session_id)
+
+        request, response = send()
+        token = request.ctx.session.login()
+
+        try:
+            self.assertTrue(token.startswith(request.ctx.session.id))
+            self.assertTrue(request.ctx.session.is_logged_in())
+            self.assertEqual(len(response.headers[b'set-cookie']), 1)
+        finally:
+            request.ctx.session.delete()
+
+    def test_sessions(self):
+        async def collect(**kwargs):
+            return [item async for item in self.sess.sessions(
+                executor=Executor(self.loop), batch_size=1, **kwargs
+            )]
+
+        self.assertEqual(self.loop.run_until_complete(collect()),
+                         [(SESSION_ID, 0xffffffff, {'foo': 'bar'})])
+        self.assertEqual(
+            self.loop.run_until_complete(collect(logged_in=True)), []
+        )
+
+        sess = Session(Application(), store=SocketStore('test.sock'))
+
+        with self.assertRaises(NotImplementedError):
+            self.loop.run_until_complete(
+                sess.sessions().__anext__()
+            )
+
+    def test_pickle(self):
+        # the app is pickled to spawn the workers
+        for store in (FileStore(self.sess.path),
+                      MemoryStore(),
+                      TieredStore(MemoryStore(), FileStore(self.sess.path)),
+                      BoundedStore(FileStore(self.sess.path))):
+            app = Application()
+            sess = Session(app, store=store)
+            sess.store.set(SESSION_ID, {'foo': 'bar'})
+
+            app, sess = pickle.loads(pickle.dumps((app, sess)))
+
+            self.assertEqual(sess.store.get(SESSION_ID), {'foo': 'bar'})
+            sess.store.set(SESSION_ID, {'foo': 'baz'})
+            self.assertEqual(sess.store.get(SESSION_ID), {'foo': 'baz'})
+            self.assertTrue(sess.store.delete(SESSION_ID))
+
+        store = SocketStore('test.sock', pool_size=2)
+        store._pool.put_nowait(object())  # a pooled connection
+        store = pickle.loads(pickle.dumps(store))
+
+        self.assertEqual(store._pool.qsize(), 0)
+        self.assertEqual(store._pool.maxsize, 2)
+
+        app = Application()
+        Session(app, audit_log=AuditLog('test-audit.log'))
+        pickle.dumps(app)
+
+        store = MemoryStore()
+        store.set(SESSION_ID, {})
+        version = store.version(SESSION_ID)
+        store = pickle.loads(pickle.dumps(store))
+
+        # never hands out the copied version again
+        store.set(SESSION_ID, {})
+        self.assertGreater(store.version(SESSION_ID), version)
+
+    def test_audit_log(self):
+        log_path = os.path.join(self.sess.path, 'test-audit.log')
+        sess = Session(Application(), path='test-session',
+                       audit_log=AuditLog(log_path, buffer_size=2,
+                                          max_bytes=100, hash_ids=False))
+        request = Request(cookies={'sess': [SESSION_ID]})
+        self.loop.run_until_complete(sess._on_request(request, Response()))
+
+        try:
+            request.ctx.session.login()
+            request.ctx.session.logout()
+            request.ctx.session.delete()
+
+            self.assertFalse(os.path.exists(log_path))
+            self.assertEqual(sess.audit_log.dropped, 1)
+
+            # writes the buffer instead of dropping
+            sess.audit_log.policy = 'block'
+            request.ctx.session.logout()  # not logged in
+            request.ctx.session.login()
+            request.ctx.session.delete()
+            request.ctx.session.delete()
+            self.loop.run_until_complete(sess.audit_log.stop())
+
+            events = []
+
+            # rotated on each of the 3 writes
+            for filepath in (log_path + '.2', log_path + '.1', log_path):
+                with open(filepath) as fp:
+                    events.extend(json.loads(line) for line in fp)
+        finally:
+            for filepath in (log_path, log_path + '.1', log_path + '.2'):
+                if os.path.exists(filepath):
+                    os.unlink(filepath)
+
+        self.assertEqual([e['event'] for e in events],
+                         ['login', 'logout', 'login', 'delete', 'delete'])
+        self.assertEqual(events[0]['id'], SESSION_ID)
+
+    def test_audit_log_write_error(self):
+        log_dir = os.path.join(self.sess.path, 'test-audit')
+        audit_log = AuditLog(os.path.join(log_dir, 'audit.log'),
+                             flush_interval=0.01, hash_ids=False)
+        logger = mock.Mock()
+        self.loop.run_until_complete(
+            audit_log.start(loop=self.loop, logger=logger)
+        )
+
+        try:
+            audit_log.emit('login', SESSION_ID)
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+
+            # the directory is missing, the event is kept
+            self.assertTrue(logger.error.called)
+            self.assertEqual(len(audit_log._buffer), 1)
+            self.assertFalse(audit_log._task.done())
+
+            os.mkdir(log_dir)
+            audit_log.emit('logout', SESSION_ID)
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+            self.assertEqual(len(audit_log._buffer), 0)
+            self.loop.run_until_complete(audit_log.stop())
+
+            with open(audit_log.path) as fp:
+                self.assertEqual([json.loads(line)['event'] for line in fp],
+                                 ['login', 'logout'])
+        finally:
+            shutil.rmtree(log_dir, ignore_errors=True)
+
+    @unittest.skipIf(not hasattr(FileStore, 'compare_and_set'),
+                     'requires fcntl.flock()')
+    def test_cas(self):
+        sess = Session(Application(), path='test-session', cas=True)
+
+        def send():
+            request = Request(cookies={'sess': [SESSION_ID]})
+            self.loop.run_until_complete(sess._on_request(request, Response()))
+            return request
+
+        # concurrent requests of the same session
+        requests = [send() for _ in range(3)]
+        requests[0].ctx.session['a'] = 1
+        requests[1].ctx.session['b'] = 2
+        del requests[2].ctx.session['foo']
+
+        for request in requests:
+            self.loop.run_until_complete(sess._on_response(request))
+
+        self.assertEqual(sess.store.get(SESSION_ID), {'a': 1, 'b': 2})
+        self.assertEqual(requests[2].ctx.session, {'a': 1, 'b': 2})
+        self.assertEqual(requests[2].ctx.session.version,
+                         sess.store.version(SESSION_ID))
+
+        # deleted meanwhile
+        request = send()
+        request.ctx.session['c'] = 3
+        sess.store.delete(SESSION_ID)
+        self.loop.run_until_complete(sess._on_response(request))
+        self.assertFalse(sess.store.exists(SESSION_ID))
+
+        # expired, but the file is still there
+        expired_id = b64encode(b'\x00\x00\x00\x01_expired').decode('latin-1')
+        sess.store.set(expired_id, {'foo': 'bar'})
+
+        request = Request(cookies={'sess': [expired_id]})
+        self.loop.run_until_complete(sess._on_request(request, Response()))
+        session = request.ctx.session
+        self.assertNotEqual(session.id, expired_id)
+        self.assertIsNone(session.version)
+
+        session['a'] = 1
+        self.loop.run_until_complete(sess._on_response(request))
+        self.assertEqual(sess.store.get(session.id), {'a': 1})
+        sess.store.delete(session.id)
+
+    def test_router(self):
+        router = SessionRouter(Application())
+        admin = Session(router, name='admin', path='test-session',
+                        paths=('/admin',))
+        default = Session(router, path='test-session')
+
+        with self.assertRaises(ValueError):
+            Session(router, name='other', paths=('/admin/',))
+
+        with self.assertRaises(ValueError):
+            Session(router, name='other')
+
+        self.assertIs(router.match(b'/admin/users/1'), admin)
+        self.assertIs(router.match(b'/admin'), admin)
+        self.assertIs(router.match(b'/administrator'), default)
+        self.assertIs(router.match(b'/'), default)
+        self.assertIsNone(router.match(b'/a' * 300))
+
+        # nested prefixes
+        other = SessionRouter(Application())
+        users = Session(other, name='users', path='test-session',
+                        paths=('/admin/users',))
+        self.assertIs(other.match(b'/admin/users/1'), users)
+        self.assertIsNone(other.match(b'/admin/1'))
+
+        other_admin = Session(other, name='admin', path='test-session',
+                              paths=('/admin',))
+        self.assertIs(other.match(b'/admin/users/1'), users)
+        self.assertIs(other.match(b'/admin/1'), other_admin)
+
+        other = SessionRouter(Application())
+        other_default = Session(other, path='test-session')
+        self.assertIs(other.match(b'/a' * 300), other_default)
+
+        request = Request(path=b'/admin/users',
+                          cookies={'admin': [SESSION_ID]})
+        self.loop.run_until_complete(
+            router._on_request(request, Response())
+        )
+        self.assertIs(request.ctx.session._sess, admin)
+        self.assertEqual(request.ctx.session, {'foo': 'bar'})
+
+        request.ctx.session['baz'] = 'qux'
+        self.loop.run_until_complete(router._on_response(request))
+        self.assertEqual(admin.store.get(SESSION_ID),
+                         {'foo': 'bar', 'baz': 'qux'})
+
+    def test_recorder(self):
+        trace_path = os.path.join(self.sess.path, 'test-trace.jsonl')
+        sess = Session(Application(), path='test-session', paths=('/app',),
+                       recorder=TraceRecorder(trace_path, path_depth=1))
+
+        def send(path, **kwargs):
+            request = Request(path=path, **kwargs)
+            self.loop.run_until_complete(
+                sess._on_request(request, Response())
+            )
+            return request
+
+        send(b'/other')
+        send(b'/app/users/1')
+        request = send(b'/app/users/1', cookies={'sess': [SESSION_ID]})
+        request.ctx.session['baz'] = 'qux'
+        self.loop.run_until_complete(sess._on_response(request))
+
+        try:
+            self.assertFalse(os.path.exists(trace_path))
+            self.loop.run_until_complete(sess.recorder.stop())
+            records = list(read_trace(trace_path))
+        finally:
+            os.unlink(trace_path)
+
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[0]['match'], False)
+        self.assertEqual(records[1]['path'], '/app')
+        self.assertEqual(records[1]['new'], True)
+        self.assertEqual(records[2]['auth'], 'cookie')
+        self.assertEqual(records[2]['read'], 14)
+        self.assertEqual(records[2]['written'], 28)
+        self.assertEqual(len(records[2]['id']), 16)
+        self.assertNotIn(SESSION_ID, json.dumps(records))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,730 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from base64 import urlsafe_b64encode as b64encode
+from unittest import mock
+
+# makes imports relative from the repo directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tremolo.exceptions import (  # noqa: E402
+    PayloadTooLarge,
+    ServiceUnavailable
+)
+from tremolo_login import (  # noqa: E402
+    FileStore,
+    MemoryStore,
+    TieredStore,
+    SocketStore,
+    BoundedStore,
+    Invalidator
+)
+from tremolo_login import daemon  # noqa: E402
+from tremolo_login.daemon import (  # noqa: E402
+    SessionServer,
+    OP_GET,
+    OP_SET,
+    STATUS_OK,
+    STATUS_NOT_FOUND
+)
+from tremolo_login.utils import now  # noqa: E402
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+def make_id(exp=0xffffffff):
+    return b64encode(
+        exp.to_bytes(4, byteorder='big') + os.urandom(44)
+    ).decode('latin-1')
+
+
+class TestStores(unittest.TestCase):
+    def setUp(self):
+        print('\r\n[', self.id(), ']')
+
+        self.loop = asyncio.new_event_loop()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.path)
+
+    def test_file_store(self):
+        store = FileStore(self.path)
+        session_id = make_id()
+
+        self.assertIsNone(store.get(session_id))
+        self.assertFalse(store.exists(session_id))
+
+        store.set(session_id, {'foo': 'bar'})
+        self.assertTrue(store.exists(session_id))
+        self.assertEqual(store.get(session_id), {'foo': 'bar'})
+        self.assertEqual(os.listdir(self.path), [session_id])
+
+        self.assertTrue(store.delete(session_id))
+        self.assertFalse(store.delete(session_id))
+
+        # expired
+        session_id = make_id(0)
+        store.set(session_id, {'foo': 'bar'})
+        self.assertIsNone(store.get(session_id))
+        self.assertFalse(store.exists(session_id))
+
+    def test_file_store_concurrent_set(self):
+        store = FileStore(self.path)
+        session_id = make_id()
+        errors = []
+
+        def write(i):
+            try:
+                for j in range(50):
+                    store.set(session_id, {'n': i * j})
+            except OSError as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=write, args=(i,))
+                   for i in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertIn('n', store.get(session_id))
+        self.assertEqual(os.listdir(self.path), [session_id])
+
+        # on Windows, the file may be open in another thread for a while
+        replace = os.replace
+        calls = []
+
+        def busy_replace(src, dst):
+            calls.append(src)
+
+            if len(calls) < 3:
+                raise PermissionError(13, 'Access is denied')
+
+            replace(src, dst)
+
+        with mock.patch('tremolo_login.stores._REPLACE_RETRY_DELAYS',
+                        (0, 0)), \
+                mock.patch('tremolo_login.stores.os.replace', busy_replace):
+            store.set(session_id, {'n': 'retried'})
+            self.assertEqual(len(calls), 3)
+
+            calls.clear()
+
+            with mock.patch('tremolo_login.stores._REPLACE_RETRY_DELAYS',
+                            (0,)), self.assertRaises(PermissionError):
+                store.set(session_id, {'n': 'failed'})
+
+        self.assertEqual(store.get(session_id), {'n': 'retried'})
+        self.assertEqual(os.listdir(self.path), [session_id])
+
+    def test_file_store_split_auth(self):
+        store = FileStore(self.path, split_auth=True)
+        session_id = make_id()
+
+        store.set(session_id, {'sid': 'x' * 64, 'foo': 'bar'})
+        self.assertEqual(store.get_auth(session_id), {'sid': 'x' * 64})
+        self.assertEqual(store.get(session_id), {'sid': 'x' * 64,
+                                                 'foo': 'bar'})
+
+        # plain JSON sessions are still readable
+        store.split_auth = False
+        store.set(session_id, {'sid': 'y' * 64, 'foo': 'bar'})
+        self.assertEqual(store.get_auth(session_id), {'sid': 'y' * 64})
+        self.assertIsNone(store.get_auth(make_id()))
+
+    def test_file_store_delta(self):
+        store = FileStore(self.path, split_auth=True, delta=True,
+                          compact_after=2)
+        session_id = make_id()
+        data = {'sid': 'x' * 64, 'payload': 'x' * 1000, 'n': 0}
+
+        # written in full when it doesn't exist
+        store.update(session_id, data, data, [])
+        size = os.path.getsize(store.filepath(session_id))
+
+        store.update(session_id, dict(data, n=1), {'n': 1}, [])
+        data = {'sid': 'x' * 64, 'n': 1}
+        store.update(session_id, data, {}, ['payload'])
+        self.assertEqual(store.get(session_id), data)
+        self.assertEqual(store.get_auth(session_id), {'sid': 'x' * 64})
+        self.assertLess(os.path.getsize(store.filepath(session_id)),
+                        size + 100)
+
+        # a partially appended change is ignored
+        with open(store.filepath(session_id), 'a') as fp:
+            fp.write('\n[{"n": 2}')
+
+        self.assertEqual(store.get(session_id), data)
+
+        # compacted
+        store.update(session_id, dict(data, n=2), {'n': 2}, [])
+
+        with open(store.filepath(session_id)) as fp:
+            self.assertEqual(fp.read(), 'x' * 64 + '\n{"n": 2}')
+
+        store.update(session_id, {'n': 2}, {}, ['sid'])
+        self.assertEqual(store.get_auth(session_id), {})
+        self.assertEqual(store.get(session_id), {'n': 2})
+
+    def test_file_store_multiple_paths(self):
+        paths = [os.path.join(self.path, str(i)) for i in range(3)]
+        store = FileStore(paths[:2])
+        ids = [make_id() for _ in range(60)]
+
+        for session_id in ids:
+            store.set(session_id, {'id': session_id})
+
+        self.assertTrue(os.listdir(paths[0]))
+        self.assertTrue(os.listdir(paths[1]))
+
+        # add a directory
+        store = FileStore(paths)
+        moved = store.rebalance()
+
+        self.assertEqual(moved, len(os.listdir(paths[2])))
+        self.assertTrue(0 < moved < len(ids))
+        self.assertEqual(store.rebalance(), 0)
+
+        for session_id in ids:
+            self.assertEqual(store.get(session_id), {'id': session_id})
+
+    def test_file_store_buckets(self):
+        store = FileStore(self.path, bucket_size=3600)
+        session_id = make_id()
+        expired_id = make_id(3600)
+        bucket = str(0xffffffff // 3600)
+
+        store.set(session_id, {'foo': 'bar'})
+        store.set(expired_id, {'foo': 'bar'})
+        self.assertEqual(store.filepath(session_id),
+                         os.path.join(self.path, bucket, session_id))
+        self.assertEqual(store.get(session_id), {'foo': 'bar'})
+        self.assertEqual(sorted(os.listdir(self.path)), ['1', bucket])
+
+        # the whole bucket is gone, the other one is left as is
+        self.assertEqual(store.sweep(), 1)
+        self.assertEqual(os.listdir(self.path), [bucket])
+        self.assertTrue(store.exists(session_id))
+
+        # back to the flat layout
+        store = FileStore(self.path)
+        self.assertEqual(store.rebalance(), 1)
+        self.assertEqual(store.get(session_id), {'foo': 'bar'})
+        self.assertEqual(store.recent(10), [session_id])
+
+    def test_scan(self):
+        ids = [make_id(0xfffffff0 - i * 3600) for i in range(3)]
+        l2 = FileStore(self.path, split_auth=True, bucket_size=3600)
+        store = TieredStore(MemoryStore(), l2, write_policy='write-back')
+        store.set(ids[0], {'sid': 'x' * 64})
+        store.set(make_id(0), {})  # expired
+        store.flush()
+        store.set(ids[1], {'foo': 'bar'})
+        store.set(ids[2], {'sid': 'y' * 64})
+
+        self.assertEqual(len(list(l2.scan())), 1)
+        self.assertEqual(sorted(store.scan()), sorted([
+            (ids[0], 0xfffffff0, {'sid': 'x' * 64}),
+            (ids[1], 0xfffffff0 - 3600, {'foo': 'bar'}),
+            (ids[2], 0xfffffff0 - 7200, {'sid': 'y' * 64})
+        ]))
+
+        store.flush()
+
+        for s in (l2, store.l1):
+            self.assertEqual(
+                sorted(item[0] for item in s.scan(logged_in=True)),
+                sorted([ids[0], ids[2]])
+            )
+            self.assertEqual(
+                [item[0] for item in s.scan(logged_in=False)], [ids[1]]
+            )
+            self.assertEqual(
+                [item[0] for item in s.scan(
+                    expires_after=0xfffffff0 - 5000,
+                    expires_before=0xfffffff0 - 1
+                )], [ids[1]]
+            )
+
+        self.assertEqual(list(l2.scan(expires_before=0xfffffff0 - 7201)), [])
+
+    def test_compare_and_set(self):
+        stores = [MemoryStore()]
+
+        if hasattr(FileStore, 'compare_and_set'):
+            stores.extend([FileStore(self.path),
+                           FileStore(self.path, delta=True)])
+
+        for store in stores:
+            session_id = make_id()
+            store.set(session_id, {'n': 0})
+            version = store.version(session_id)
+
+            self.assertIsNone(store.compare_and_set(make_id(), {}, version))
+
+            new_version = store.compare_and_set(
+                session_id, {'n': 1}, version, {'n': 1}, []
+            )
+            self.assertEqual(new_version, store.version(session_id))
+            self.assertNotEqual(new_version, version)
+
+            # stale
+            self.assertIsNone(
+                store.compare_and_set(session_id, {'n': 2}, version)
+            )
+            self.assertEqual(store.get(session_id), {'n': 1})
+
+    def test_many(self):
+        for store in (
+                MemoryStore(),
+                FileStore(self.path, max_workers=4),
+                FileStore(self.path, bucket_size=3600, max_workers=1),
+                TieredStore(MemoryStore(), FileStore(self.path)),
+                TieredStore(MemoryStore(maxsize=2), FileStore(self.path),
+                            write_policy='write-back'),
+                BoundedStore(FileStore(self.path), max_sessions=10)):
+            ids = [make_id() for _ in range(5)]
+            missing = make_id()
+
+            store.set_many((session_id, {'n': i})
+                           for i, session_id in enumerate(ids))
+            self.assertEqual(store.get(ids[0]), {'n': 0})
+            self.assertEqual(
+                store.get_many(ids + [missing]),
+                {session_id: {'n': i} for i, session_id in enumerate(ids)}
+            )
+
+            self.assertEqual(store.delete_many(ids[:3] + [missing]), 3)
+            self.assertEqual(store.get_many(ids),
+                             {ids[3]: {'n': 3}, ids[4]: {'n': 4}})
+
+            if isinstance(store, TieredStore):
+                store.flush()
+
+            self.assertEqual(store.delete_many(ids), 2)
+            self.assertEqual(store.get_many(ids), {})
+
+            if isinstance(store, BoundedStore):
+                self.assertEqual(len(store), 0)
+
+            if hasattr(store, 'stop'):
+                self.loop.run_until_complete(store.stop())
+
+    def test_memory_store_lru(self):
+        store = MemoryStore(maxsize=2)
+        ids = [make_id() for _ in range(3)]
+
+        store.set(ids[0], {'n': 0})
+        store.set(ids[1], {'n': 1})
+        store.get(ids[0])
+        store.set(ids[2], {'n': 2})
+
+        self.assertEqual(len(store), 2)
+        self.assertIsNone(store.get(ids[1]))
+        self.assertEqual(store.get(ids[0]), {'n': 0})
+
+        session_id = make_id(0)
+        store.set(session_id, {'foo': 'bar'})
+        self.assertIsNone(store.get(session_id))
+
+        # each read is a copy
+        store.set(ids[0], {'cart': []})
+        store.get(ids[0])['cart'].append('item')
+        self.assertEqual(store.get(ids[0]), {'cart': []})
+        self.assertEqual(store.sizes(),
+                         [(ids[0], 0xffffffff, len('{"cart": []}'))])
+
+    def test_memory_store_snapshot(self):
+        snapshot_path = os.path.join(self.path, 'sess.snapshot')
+        store = MemoryStore(snapshot_path=snapshot_path, snapshot_interval=0)
+        ids = [make_id() for _ in range(3)]
+
+        for i, session_id in enumerate(ids):
+            store.set(session_id, {'n': i})
+
+        store.set(make_id(0), {})  # expired
+        store.get(ids[0])
+        self.loop.run_until_complete(store.stop())
+
+        if fcntl is None:
+            self.assertEqual(os.listdir(self.path), ['sess.snapshot'])
+        else:
+            self.assertEqual(sorted(os.listdir(self.path)),
+                             ['sess.snapshot.0', 'sess.snapshot.0.lock'])
+
+        store = MemoryStore(maxsize=2, snapshot_path=snapshot_path)
+        self.loop.run_until_complete(store.start(loop=self.loop))
+
+        # the least recently used is evicted first
+        self.assertEqual(list(store._data), [ids[2], ids[0]])
+        self.assertEqual(store.get(ids[0]), {'n': 0})
+        self.assertIsNotNone(store._task)
+        self.loop.run_until_complete(store.stop())
+
+    @unittest.skipIf(fcntl is None, 'requires fcntl.flock()')
+    def test_memory_store_snapshot_workers(self):
+        snapshot_path = os.path.join(self.path, 'sess.snapshot')
+        workers = [MemoryStore(snapshot_path=snapshot_path,
+                               snapshot_interval=0) for _ in range(2)]
+
+        for i, store in enumerate(workers):
+            self.loop.run_until_complete(store.start(loop=self.loop))
+            store.set(make_id(), {'worker': i})
+
+        for store in workers:
+            self.loop.run_until_complete(store.stop())
+
+        # restarted, each file is restored by one of them
+        workers = [MemoryStore(snapshot_path=snapshot_path)
+                   for _ in range(2)]
+
+        for store in workers:
+            self.loop.run_until_complete(store.start(loop=self.loop))
+
+        self.assertEqual(sorted(data['worker'] for store in workers
+                                for _, _, data in store.scan()), [0, 1])
+
+        for store in workers:
+            self.loop.run_until_complete(store.stop())
+
+        self.assertEqual(store.load_snapshot(os.path.join(self.path, 'x')),
+                         0)
+
+    def test_tiered_store_write_through(self):
+        l2 = FileStore(self.path)
+        store = TieredStore(MemoryStore(), l2)
+        session_id = make_id()
+
+        store.set(session_id, {'foo': 'bar'})
+        self.assertEqual(l2.get(session_id), {'foo': 'bar'})
+        self.assertEqual(store.get(session_id), {'foo': 'bar'})
+
+        # read-through with promotion
+        other_id = make_id()
+        l2.set(other_id, {'baz': 'qux'})
+        self.assertEqual(store.get(other_id), {'baz': 'qux'})
+        self.assertEqual(store.l1.get(other_id), {'baz': 'qux'})
+        self.assertEqual(store.get(other_id), {'baz': 'qux'})
+
+        self.assertEqual(store.stats()['hits'], 2)
+        self.assertEqual(store.stats()['misses'], 1)
+        self.assertAlmostEqual(store.hit_ratio, 2 / 3)
+
+        self.assertTrue(store.delete(session_id))
+        self.assertFalse(l2.exists(session_id))
+
+    def test_tiered_store_write_back(self):
+        l2 = FileStore(self.path)
+        store = TieredStore(MemoryStore(maxsize=1), l2,
+                            write_policy='write-back', flush_interval=60)
+        session_id = make_id()
+        self.loop.run_until_complete(store.start(loop=self.loop))
+
+        store.set(session_id, {'foo': 'bar', 'cart': []})
+        self.assertFalse(l2.exists(session_id))
+
+        # evicted from L1, but still served from the dirty set, as a copy
+        store.set(make_id(), {})
+        store.get(session_id)['cart'].append('item')
+        store.get_many([session_id])[session_id]['cart'].append('item')
+        self.assertEqual(store.get(session_id), {'foo': 'bar', 'cart': []})
+
+        store.flush()
+        self.assertEqual(l2.get(session_id), {'foo': 'bar', 'cart': []})
+
+        store.delete(session_id)
+        self.assertFalse(store.exists(session_id))
+        self.assertIsNone(store.get(session_id))
+        self.assertTrue(l2.exists(session_id))
+
+        self.loop.run_until_complete(store.stop())
+        self.assertFalse(l2.exists(session_id))
+
+    def test_tiered_store_warm_up(self):
+        l2 = FileStore(self.path)
+        ids = [make_id() for _ in range(5)]
+
+        for i, session_id in enumerate(ids):
+            l2.set(session_id, {'n': i})
+            os.utime(l2.filepath(session_id), (i, i))
+
+        l2.set(make_id(0), {})  # expired
+        store = TieredStore(MemoryStore(maxsize=10), l2, warm_up=3)
+
+        self.assertEqual(l2.recent(10), ids[::-1])
+        self.loop.run_until_complete(store.start(loop=self.loop))
+
+        self.assertEqual(list(store.l1._data), ids[2:])
+        self.assertEqual(store.get(ids[4]), {'n': 4})
+        self.assertEqual(store.hits, 1)
+
+        self.assertEqual(store.preload(10, budget=-1), 0)
+
+    def test_tiered_store_bad_policy(self):
+        with self.assertRaises(ValueError):
+            TieredStore(MemoryStore(), FileStore(self.path),
+                        write_policy='write-around')
+
+    def test_bounded_store(self):
+        l2 = FileStore(self.path)
+        ids = [make_id(0xfffffff0 - i) for i in range(4)]
+        l2.set(ids[0], {'n': 0})
+
+        store = BoundedStore(l2, max_payload=20, max_sessions=2)
+
+        # counted from the file sizes, without reading the sessions
+        with mock.patch.object(l2, 'get', side_effect=AssertionError):
+            self.loop.run_until_complete(store.start())
+
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.size, len('{"n": 0}'))
+
+        with self.assertRaises(PayloadTooLarge):
+            store.set(ids[1], {'n': 'x' * 20})
+
+        store.set(ids[1], {'n': 1})
+        store.set(ids[1], {'n': 11})
+        self.assertEqual(store.size, 17)
+
+        with self.assertRaises(ServiceUnavailable):
+            store.set(ids[2], {'n': 2})
+
+        # the soonest-expiring one is evicted
+        store.policy = 'evict'
+        store.set(ids[2], {'n': 2})
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         sorted([ids[0], ids[2]]))
+
+        # only the logged in ones are let in
+        store.policy = 'refuse-anonymous'
+
+        with self.assertRaises(ServiceUnavailable):
+            store.set(ids[3], {'n': 3})
+
+        store.set(ids[3], {'sid': 'x'})
+        self.assertEqual(len(store), 3)
+
+        self.assertTrue(store.delete(ids[3]))
+        self.assertEqual(len(store), 2)
+        self.assertTrue(store.blocking)
+
+        # the session being saved is the soonest, but it stays evictable
+        store.policy = 'evict'
+        store.max_bytes = store.size
+        store.set(ids[2], {'n': 22})
+        self.assertEqual(os.listdir(self.path), [ids[2]])
+        self.assertIn((0xfffffff0 - 2, ids[2]), store._expiry)
+
+    def test_bounded_store_deleted_then_expired(self):
+        store = BoundedStore(FileStore(self.path), max_sessions=100)
+        expiring_id = make_id(now() + 1)
+        session_id = make_id()
+
+        store.set(expiring_id, {})
+        store.set(session_id, {})
+        store.delete(expiring_id)
+
+        with mock.patch('tremolo_login.stores.now',
+                        return_value=now() + 10):
+            store.set(make_id(), {})
+
+        self.assertEqual(store.get(session_id), {})
+        self.assertEqual(len(store), 2)
+
+    @unittest.skipIf(sys.platform == 'win32', 'requires Unix domain sockets')
+    def test_tiered_store_invalidation(self):
+        path = os.path.join(self.path, 'inval')
+        l2 = FileStore(self.path)
+        workers = [TieredStore(MemoryStore(), l2,
+                               invalidator=Invalidator(path))
+                   for _ in range(2)]
+        session_id = make_id()
+
+        for store in workers:
+            self.loop.run_until_complete(store.start(loop=self.loop))
+
+        try:
+            workers[0].set(session_id, {'foo': 'bar'})
+            self.assertEqual(workers[1].get(session_id), {'foo': 'bar'})
+            generation = workers[1].invalidator.generation(session_id)
+
+            workers[0].set(session_id, {'foo': 'baz'})
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+
+            self.assertIsNone(workers[1].l1.get(session_id))
+            self.assertEqual(workers[1].get(session_id), {'foo': 'baz'})
+            self.assertNotEqual(
+                workers[1].invalidator.generation(session_id), generation
+            )
+            self.assertEqual(workers[0].invalidator.generation(session_id),
+                             generation)
+
+            # changed by the other worker while L2 was being read
+            get = l2.get
+
+            def get_and_change(session_id):
+                data = get(session_id)
+                workers[0].set(session_id, {'foo': 'qux'})
+                workers[1].invalidator._receive()
+                return data
+
+            workers[1].l1.delete(session_id)
+
+            with mock.patch.object(l2, 'get', get_and_change):
+                self.assertEqual(workers[1].get(session_id), {'foo': 'baz'})
+
+            self.assertIsNone(workers[1].l1.get(session_id))
+            self.assertEqual(workers[1].get(session_id), {'foo': 'qux'})
+
+            # the other workers are not listed on every change
+            with mock.patch('tremolo_login.invalidation.os.listdir') as ls:
+                workers[0].set(session_id, {'foo': 'bar'})
+
+            ls.assert_not_called()
+
+            workers[0].delete(session_id)
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+            self.assertIsNone(workers[1].get(session_id))
+        finally:
+            for store in workers:
+                self.loop.run_until_complete(store.stop())
+
+        self.assertEqual(os.listdir(path), [])
+
+    @unittest.skipIf(sys.platform == 'win32', 'requires Unix domain sockets')
+    def test_daemon_no_sweep(self):
+        server = SessionServer(os.path.join(self.path, 'sess.sock'),
+                               sweep_interval=0)
+
+        with mock.patch.object(server, 'sweep') as sweep:
+            with self.assertRaises(asyncio.TimeoutError):
+                self.loop.run_until_complete(
+                    asyncio.wait_for(server.serve(), 0.1)
+                )
+
+        sweep.assert_not_called()
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_daemon_spawn(self):
+        with mock.patch('subprocess.Popen') as popen:
+            daemon.spawn('sess.sock', maxsize=10, sweep_interval=0,
+                         snapshot_path='sess.snapshot', snapshot_interval=1)
+
+        # the command line that spawn() builds is understood by main()
+        args = popen.call_args[0][0]
+
+        with mock.patch('sys.argv', args[2:]), \
+                mock.patch.object(daemon, 'SessionServer',
+                                  side_effect=RuntimeError) as server:
+            with self.assertRaises(RuntimeError):
+                daemon.main()
+
+        server.assert_called_once_with('sess.sock', maxsize=10,
+                                       sweep_interval=0,
+                                       snapshot_path='sess.snapshot',
+                                       snapshot_interval=1)
+
+        with self.assertRaises(TypeError):
+            daemon.spawn('sess.sock', snapshot='sess.snapshot')
+
+    @unittest.skipIf(sys.platform == 'win32', 'requires Unix domain sockets')
+    def test_socket_store(self):
+        path = os.path.join(self.path, 'sess.sock')
+        server = SessionServer(path)
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(server.serve())
+
+        def serve():
+            try:
+                loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                pass
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+
+        store = SocketStore(path, pool_size=2)
+
+        try:
+            for _ in range(50):
+                if os.path.exists(path):
+                    break
+
+                thread.join(0.1)
+
+            session_id = make_id()
+            self.assertIsNone(store.get(session_id))
+            self.assertFalse(store.exists(session_id))
+            self.assertIsNone(store.version(session_id))
+
+            store.set(session_id, {'foo': 'bar'})
+            self.assertTrue(store.exists(session_id))
+            self.assertEqual(store.get(session_id), {'foo': 'bar'})
+            self.assertEqual(store.version(session_id), 1)
+
+            # batched commands
+            other_id = make_id()
+            self.assertEqual(store.execute((
+                (OP_SET, other_id, b'{}'),
+                (OP_GET, other_id, b''),
+                (OP_GET, make_id(), b'')
+            )), [(STATUS_OK, b''), (STATUS_OK, b'{}'),
+                 (STATUS_NOT_FOUND, b'')])
+
+            self.assertTrue(store.delete(session_id))
+            self.assertFalse(store.delete(session_id))
+
+            ids = [make_id() for _ in range(3)]
+            store.set_many({session_id: {'n': i}
+                            for i, session_id in enumerate(ids)})
+            self.assertEqual(store.get_many(ids + [session_id]),
+                             {ids[0]: {'n': 0}, ids[1]: {'n': 1},
+                              ids[2]: {'n': 2}})
+            self.assertEqual(store.delete_many(ids + [session_id]), 3)
+            self.assertEqual(store.get_many(ids), {})
+
+            with self.assertRaises(ValueError):
+                store.set_many({'/../etc/passwd': {}})
+
+            store.set(make_id(0), {'foo': 'bar'})
+            self.assertEqual(server.sweep(), 1)
+
+            server.snapshot_path = os.path.join(self.path, 'sess.snapshot')
+            self.assertEqual(asyncio.run_coroutine_threadsafe(
+                server.snapshot(), loop
+            ).result(), 1)
+
+            restored = SessionServer(path,
+                                     snapshot_path=server.snapshot_path)
+            self.assertEqual(restored.restore(), 1)
+            self.assertEqual(restored.execute(OP_GET, other_id, b''),
+                             (STATUS_OK, b'{}'))
+
+            with self.assertRaises(ValueError):
+                store.set('/../etc/passwd', {})
+        finally:
+            store.close()
+            loop.call_soon_threadsafe(task.cancel)
+            thread.join()
+            loop.close()
+
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,51 +1,104 @@
 # SPDX-License-Identifier: MIT
 # Copyright (c) 2023 Anggit Arfanto
 
+import asyncio
 import hashlib
 import hmac
 import json
 import os
 import tempfile
-import time
 
-from base64 import b64decode, urlsafe_b64encode as b64encode
+from base64 import urlsafe_b64encode as b64encode
+from copy import deepcopy
+from itertools import islice
 
 from tremolo.exceptions import Forbidden
 
-__version__ = '1.1.1'
-__all__ = ['Session']
-
-
-def now():
-    return int(time.time()) & 0xffffffff
-
+from .audit import AuditLog
+from .invalidation import Invalidator
+from .recorder import TraceRecorder
+from .router import SessionRouter
+from .stores import (
+    FileStore,
+    MemoryStore,
+    TieredStore,
+    SocketStore,
+    BoundedStore
+)
+from .tracing import NULL_TRACE, SlowLog
+from .utils import now, get_exp_time
 
-def get_exp_time(session_id):
-    """The first 4 bytes of the raw `session_id` is the expiration time."""
-    return int.from_bytes(
-        b64decode(session_id, altchars=b'-_', validate=True)[:4],
-        byteorder='big'
-    )
+__version__ = '1.1.1'
+__all__ = ['Session', 'SessionRouter', 'FileStore', 'MemoryStore',
+           'TieredStore', 'SocketStore', 'BoundedStore', 'Invalidator',
+           'AuditLog', 'SlowLog', 'TraceRecorder']
 
 
 class Session:
     def __init__(self, app, name='sess', path='sess', paths=(),
-                 expires=1800, cookie_params={}):
+                 expires=1800, cookie_params={}, connection_cache=False,
+                 store=None, lazy_load=False, slow_log=None, recorder=None,
+                 defer_id=False, audit_log=None, cas=False):
         """A simple, file-based session middleware for Tremolo.
 
-        :param app: The Tremolo app object
+        :param app: The Tremolo app object, or a ``SessionRouter``
         :param name: Session name. Will be used in the response header. E.g.
             ``Set-Cookie: sess=Base64stringHere;``
         :param path: A session directory path where the session files will be
             stored. E.g. ``/path/to/dir``. If it doesn't exist, it will be
             created under the Operating System temporary directory.
+            It can also be a list of directories, e.g. on different disks.
+            The sessions will then be spread across them.
         :param paths: A list of url path prefixes
             where the ``Set-Cookie`` header should appear.
             ``['/']`` will match ``/any``,
             ``['/users']`` will match ``/users/login``, etc.
+        :param connection_cache: Remember the loaded session for the lifetime
+            of the connection. Subsequent keep-alive requests only need to
+            revalidate it with a ``stat()`` instead of reading the file.
+        :param store: Where the sessions are stored. Defaults to
+            ``FileStore(path)``. E.g. ``TieredStore(MemoryStore(),
+            FileStore('/path/to/dir'), write_policy='write-back')``
+        :param lazy_load: Only load the login state (``sid``) up front.
+            The rest of the session is loaded when the handler reads
+            other keys. The file store keeps the ``sid`` on the first line
+            of the session file, so it can be read separately.
+        :param slow_log: A ``SlowLog`` object. E.g. ``SlowLog(threshold=0.05)``
+            to log the session operations that take longer than 50ms,
+            with their phase timings.
+        :param recorder: A ``TraceRecorder`` object. E.g.
+            ``TraceRecorder('/path/to/trace.jsonl')`` to record anonymized
+            traffic for ``benchmarks/replay.py``.
+        :param defer_id: Requests without a session cookie get an empty
+            session without an id. The id is only created, and the cookie
+            set, when the session is written to or ``login()`` is called.
+            So crawlers and health checks cost no id and no ``Set-Cookie``.
+        :param audit_log: An ``AuditLog`` object. E.g.
+            ``AuditLog('/path/to/audit.log')`` to record every ``login()``,
+            ``logout()`` and ``delete()``.
+        :param cas: Save a session only if no one else has saved it since
+            it was loaded. Otherwise, load it again, apply the changed keys
+            on top of it and retry. So concurrent requests of the same
+            session don't overwrite each other's changes.
         """
         self.name = name
-        self.path = self._get_path(path, app.__class__.__name__)
+
+        if isinstance(app, SessionRouter):
+            prefix = app.app.__class__.__name__
+        else:
+            prefix = app.__class__.__name__
+
+        if store is None:
+            if isinstance(path, str):
+                self.path = self._get_path(path, prefix)
+            else:
+                self.path = [self._get_path(v, prefix) for v in path]
+
+            self.store = FileStore(self.path, split_auth=lazy_load)
+        else:
+            self.path = getattr(store, 'path', None)
+            self.store = store
+
         self.paths = {v.rstrip('/').encode('latin-1') for v in paths}
         self.expires = min(expires, 31968000)
 
@@ -53,9 +106,36 @@ class Session:
         cookie_params['expires'] = 34560000
 
         self.cookie_params = cookie_params
+        self.connection_cache = connection_cache
+        self.lazy_load = lazy_load and hasattr(self.store, 'get_auth')
+        self.slow_log = slow_log
+        self.recorder = recorder
+        self.defer_id = defer_id
+        self.audit_log = audit_log
+        self.cas = cas and hasattr(self.store, 'compare_and_set')
+        self.invalidator = getattr(self.store, 'invalidator', None)
+
+        # in-flight loads, shared by concurrent requests of the same session
+        self._loading = {}
+
+        if hasattr(self.store, 'start'):
+            app.add_hook(self.store.start, 'worker_start')
+
+        if hasattr(self.store, 'stop'):
+            app.add_hook(self.store.stop, 'worker_stop')
 
-        app.add_middleware(self._on_request, 'request')
-        app.add_middleware(self._on_response, 'response')
+        if recorder is not None:
+            app.add_hook(recorder.stop, 'worker_stop')
+
+        if audit_log is not None:
+            app.add_hook(audit_log.start, 'worker_start')
+            app.add_hook(audit_log.stop, 'worker_stop')
+
+        if isinstance(app, SessionRouter):
+            app.add(self)
+        else:
+            app.add_middleware(self._on_request, 'request')
+            app.add_middleware(self._on_response, 'response')
 
     def _get_path(self, path, prefix):
         if os.path.isdir(path):
@@ -79,12 +159,116 @@ class Session:
                 request.uid(length, ts_offset=self.expires + i)
             ).decode('latin-1')
 
-            if not os.path.exists(os.path.join(self.path, session_id)):
+            if not self.store.exists(session_id):
                 return session_id
 
         raise FileExistsError('session id collision')
 
-    async def _on_request(self, request, response, **_):
+    def _forget(self, session_id):
+        # the requests coming after a change must not get stale data
+        self._loading.pop((session_id, False), None)
+        self._loading.pop((session_id, True), None)
+
+    async def _load(self, session_id, executor=None, auth=False):
+        func = self.store.get_auth if auth else self.store.get
+
+        if not self.store.blocking or executor is None:
+            return func(session_id)
+
+        if not auth and hasattr(self.store, 'get_cached'):
+            data = self.store.get_cached(session_id)
+
+            if data is not None:
+                return data
+
+        key = (session_id, auth)
+        entry = self._loading.get(key)
+
+        if entry is None:
+            entry = [executor.submit(func, (session_id,)), 0]  # fut, waiters
+            entry[0].add_done_callback(
+                lambda fut: self._loading.get(key) is entry and
+                self._loading.pop(key)
+            )
+            self._loading[key] = entry
+
+        entry[1] += 1
+
+        try:
+            # a cancelled request must not cancel the others waiting for it
+            data = await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+
+        if entry[1] > 0 and data is not None:
+            # the others resume after this one, the last takes the result
+            # as is. the nested values too, a handler may change them
+            return deepcopy(data)
+
+        return data
+
+    async def sessions(self, expires_after=None, expires_before=None,
+                       logged_in=None, executor=None, batch_size=100):
+        """Yields ``(session_id, expires, data)`` of the stored sessions,
+        e.g. to count, list, or export them::
+
+            async for session_id, expires, data in sess.sessions(
+                    logged_in=True, executor=server['globals'].executor):
+                ...
+
+        The filters are applied by the store, only ``batch_size`` sessions
+        are held in memory at a time. With ``executor``, the blocking
+        stores are read in its threads.
+
+        :param expires_after: Defaults to now, i.e. not expired
+        :param expires_before: Defaults to no limit
+        :param logged_in: ``True`` or ``False`` to only yield the sessions
+            with or without a ``sid``
+        """
+        if not hasattr(self.store, 'scan'):
+            raise NotImplementedError(
+                '%s does not support scan()' % self.store.__class__.__name__
+            )
+
+        items = self.store.scan(expires_after=expires_after,
+                                expires_before=expires_before,
+                                logged_in=logged_in)
+
+        while True:
+            if self.store.blocking and executor is not None:
+                batch = await executor.submit(
+                    lambda: list(islice(items, batch_size))
+                )
+            else:
+                batch = list(islice(items, batch_size))
+
+            if not batch:
+                break
+
+            for item in batch:
+                yield item
+
+    def _trace(self):
+        if self.slow_log is None:
+            return NULL_TRACE
+
+        return self.slow_log.start()
+
+    def _version(self, session_id):
+        version = self.store.version(session_id)
+
+        if version is not None and self.invalidator is not None:
+            # also changes when another worker invalidates the session
+            return (version, self.invalidator.generation(session_id))
+
+        return version
+
+    def _record_miss(self, request):
+        if self.recorder is not None:
+            self.recorder.record(request.path, match=False)
+
+    async def _on_request(self, request, response, **server):
+        trace = self._trace()
         request.ctx.session = None
         path = request.path.rstrip(b'/')
         depth = 0
@@ -96,13 +280,19 @@ class Session:
             end = path.rfind(b'/')
 
             if end == -1:
+                self._record_miss(request)
                 return
 
             path = path[:end]
             depth += 1
         else:
+            self._record_miss(request)
             return
 
+        trace.mark('match')
+        await self._handle(request, response, trace, **server)
+
+    async def _handle(self, request, response, trace=NULL_TRACE, **server):
         response.set_header(b'Cache-Control', b'no-cache, must-revalidate')
         response.set_header(b'Expires', b'Thu, 01 Jan 1970 00:00:00 GMT')
 
@@ -114,12 +304,32 @@ class Session:
 
             session_id = token[:-64].lstrip(b' /').decode('latin-1')
             sid = token[-64:].decode('latin-1')
+            auth = 'authorization'
         elif self.name in request.cookies:
             session_id = request.cookies[self.name][0].lstrip('/')
             sid = None
+            auth = 'cookie'
+        elif self.defer_id:
+            request.ctx.session = SessionData(self, None, None, {}, None,
+                                              request, response)
+            trace.finish('request', None)
+
+            if self.recorder is not None:
+                request.ctx.session.record = self.recorder.start(
+                    request.path, new=True
+                )
+
+            return
         else:
-            response.set_cookie(self.name, self._regenerate_id(request),
-                                **self.cookie_params)
+            session_id = self._regenerate_id(request)
+            trace.mark('regenerate')
+            response.set_cookie(self.name, session_id, **self.cookie_params)
+            trace.finish('request', session_id)
+
+            if self.recorder is not None:
+                self.recorder.record(request.path, session_id=session_id,
+                                     new=True)
+
             return
 
         try:
@@ -133,42 +343,115 @@ class Session:
                 set_cookie=response.headers[b'set-cookie'][-1]
             ) from exc
 
-        session_filepath = os.path.join(self.path, session_id)
-        session = {}
+        trace.mark('parse')
+        session = None
+        cache = None
+
+        if self.cas:
+            # taken before reading. if the session changes in between,
+            # the save will only merge needlessly
+            stamp = self.store.version(session_id)
+
+        if self.connection_cache and 'context' in server:
+            cache = server['context'].setdefault('sessions', {})
+            version = self._version(session_id)
+
+            if (self.name in cache and version is not None and
+                    cache[self.name][:2] == (session_id, version) and
+                    now() <= expires):
+                # kept as JSON, each request gets its own copy
+                session = json.loads(cache[self.name][2])
+
+        lazy = False
+
+        if session is None and self.lazy_load:
+            session = await self._load(
+                session_id, getattr(server.get('globals'), 'executor', None),
+                auth=True
+            )
+            lazy = session is not None
+        elif session is None:
+            session = await self._load(
+                session_id, getattr(server.get('globals'), 'executor', None)
+            )
+
+            if cache is not None and session is not None:
+                # the version is taken before reading. if the file changes
+                # in between, the next request will simply read it again
+                cache[self.name] = (session_id, version, json.dumps(session))
+
+        trace.mark('load')
+
+        if self.recorder is not None:
+            record = self.recorder.start(request.path, auth, session_id,
+                                         session, new=session is None)
+
+        # the one in the cookie, if it is kept
+        loaded = session is not None
+
+        if session is None:
+            # doesn't exist, has expired, or is corrupted
+            session = {}
+            session_id = self._regenerate_id(request)
 
-        if os.path.isfile(session_filepath):
-            if now() > expires:
-                os.unlink(session_filepath)
-            else:
-                with open(session_filepath, 'r') as fp:
-                    data = fp.read()
+        if hasattr(self.store, 'filepath'):
+            session_filepath = self.store.filepath(session_id)
+        else:
+            session_filepath = None
 
-                try:
-                    session.update(json.loads(data))
-                except ValueError:
-                    os.unlink(session_filepath)
+        request.ctx.session = (LazySessionData if lazy else SessionData)(
+            self, session_id, sid, session, session_filepath, request,
+            response
+        )
 
-        if not os.path.isfile(session_filepath):
-            session_id = self._regenerate_id(request)
-            session_filepath = os.path.join(self.path, session_id)
+        if self.recorder is not None:
+            request.ctx.session.record = record
 
-        request.ctx.session = SessionData(self,
-                                          session_id,
-                                          sid,
-                                          session,
-                                          session_filepath,
-                                          request)
+        if self.cas and loaded:
+            # a new id has no version, it is saved as usual
+            request.ctx.session.version = stamp
 
         # always renew/update session and cookie expiration time
         response.set_cookie(self.name, session_id, **self.cookie_params)
+        trace.mark('init')
+        trace.finish('request', session_id, session)
+
+    async def _on_response(self, request, **server):
+        session = request.ctx.session
+
+        if session is None:
+            return
+
+        trace = self._trace()
+        session.save()
+        trace.mark('save')
+
+        if session.modified and self.connection_cache and 'context' in server:
+            cache = server['context'].setdefault('sessions', {})
+            version = self._version(session.id)
+
+            if version is None:
+                cache.pop(self.name, None)
+            else:
+                cache[self.name] = (session.id, version,
+                                    json.dumps(session.session))
 
-    async def _on_response(self, request, **_):
-        if request.ctx.session is not None:
-            request.ctx.session.save()
+            trace.mark('cache')
+
+        trace.finish('response', session.id, session.session)
+
+        if session.record is not None:
+            session.record.finish(session.session if session.modified
+                                  else None)
 
 
 class SessionData(dict):
-    def __init__(self, sess, session_id, sid, session, filepath, request):
+    record = None
+    version = None
+
+    def __init__(self, sess, session_id, sid, session, filepath, request,
+                 response=None):
+        self._sess = sess
         self.name = sess.name
         self.path = sess.path
         self.id = session_id
@@ -176,25 +459,109 @@ class SessionData(dict):
         self.session = session
         self.filepath = filepath
         self.request = request
+        self.response = response
+        self.modified = False
 
         self.update(session)
 
+    def _create_id(self):
+        # a deferred id, see the defer_id option of Session
+        self.id = self._sess._regenerate_id(self.request)
+
+        if hasattr(self._sess.store, 'filepath'):
+            self.filepath = self._sess.store.filepath(self.id)
+
+        if self.response is not None:
+            self.response.set_cookie(self._sess.name, self.id,
+                                     **self._sess.cookie_params)
+
     def save(self):
         if self != self.session:
+            if self.id is None:
+                self._create_id()
+
+            trace = self._sess._trace()
+            store = self._sess.store
+
+            if hasattr(store, 'update') or self.version is not None:
+                # shallow copies, the unchanged values are the same objects
+                changed = {k: v for k, v in self.items()
+                           if k not in self.session or self.session[k] != v}
+                removed = [k for k in self.session if k not in self]
+
             self.session.clear()
             self.session.update(self)
+            trace.mark('copy')
+
+            if self.version is not None:
+                self._compare_and_set(changed, removed)
+            elif hasattr(store, 'update'):
+                store.update(self.id, self, changed, removed)
+            else:
+                store.set(self.id, self)
+
+            trace.mark('write')
+            self._sess._forget(self.id)
+            self.modified = True
+            trace.finish('save', self.id, self.session)
+
+    def _compare_and_set(self, changed, removed, retries=8):
+        store = self._sess.store
+
+        for _ in range(retries):
+            version = store.compare_and_set(self.id, self, self.version,
+                                            changed, removed)
+
+            if version is not None:
+                self.version = version
+                return
+
+            # someone else has saved it first, apply ours on top of theirs
+            version = store.version(self.id)
+            data = store.get(self.id)
+
+            if data is None:
+                return  # deleted meanwhile, e.g. on logout
+
+            data = dict(data)
+            data.update(changed)
 
-            with open(self.filepath, 'w') as fp:
-                json.dump(self, fp)
+            for key in removed:
+                data.pop(key, None)
+
+            dict.clear(self)
+            dict.update(self, data)
+            self.session.clear()
+            self.session.update(data)
+            self.version = version
+
+        # still contended, the merged one is the best there is
+        store.set(self.id, self)
+        self.version = store.version(self.id)
 
     def delete(self):
+        trace = self._sess._trace()
         self.clear()
         self.session.clear()
 
-        if os.path.exists(self.filepath):
-            os.unlink(self.filepath)
+        if self.id is None:
+            return
+
+        self._sess._forget(self.id)
+
+        if self._sess.store.delete(self.id):
+            self.modified = True
+
+        if self._sess.audit_log is not None:
+            self._sess.audit_log.emit('delete', self.id)
+
+        trace.mark('delete')
+        trace.finish('delete', self.id)
 
     def get_token(self, msg=b''):
+        if self.id is None:
+            self._create_id()
+
         if not msg and b'user-agent' in self.request.headers:
             msg = self.request.headers[b'user-agent'][0]
 
@@ -216,6 +583,9 @@ class SessionData(dict):
         self['sid'] = self.sid or token[-64:]
         self.save()
 
+        if self._sess.audit_log is not None:
+            self._sess.audit_log.emit('login', self.id)
+
         return token
 
     def logout(self):
@@ -223,6 +593,121 @@ class SessionData(dict):
             del self['sid']
             self.save()
 
+            if self._sess.audit_log is not None:
+                self._sess.audit_log.emit('logout', self.id)
+
     def is_logged_in(self, msg=b''):
+        if 'sid' not in self:
+            return False
+
         sid = self.sid or self.get_token(msg)[-64:]
-        return 'sid' in self and hmac.compare_digest(sid, self['sid'])
+        return hmac.compare_digest(sid, self['sid'])
+
+
+class LazySessionData(SessionData):
+    """A session that only has its login state (``sid``) at first.
+    The rest is loaded from the store on the first access to other keys,
+    and before any modification.
+    """
+
+    def __init__(self, *args):
+        self._loaded = True  # nothing to load while initializing
+        super().__init__(*args)
+        self._loaded = False
+
+    def load(self):
+        if not self._loaded:
+            self._loaded = True
+            data = self._sess.store.get(self.id) or {}
+
+            dict.update(self, data)
+            self.session.update(data)
+
+    def _load_for(self, key):
+        if key != 'sid':
+            self.load()
+
+    def __getitem__(self, key):
+        self._load_for(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self._load_for(key)
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        self._load_for(key)
+        return super().get(key, default)
+
+    def __iter__(self):
+        self.load()
+        return super().__iter__()
+
+    def __len__(self):
+        self.load()
+        return super().__len__()
+
+    def __eq__(self, other):
+        self.load()
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        self.load()
+        return super().__ne__(other)
+
+    def __repr__(self):
+        self.load()
+        return super().__repr__()
+
+    def keys(self):
+        self.load()
+        return super().keys()
+
+    def values(self):
+        self.load()
+        return super().values()
+
+    def items(self):
+        self.load()
+        return super().items()
+
+    def copy(self):
+        self.load()
+        return super().copy()
+
+    def __setitem__(self, key, value):
+        self.load()
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.load()
+        super().__delitem__(key)
+
+    def pop(self, *args):
+        self.load()
+        return super().pop(*args)
+
+    def popitem(self):
+        self.load()
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self.load()
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self.load()
+        super().update(*args, **kwargs)
+
+    def clear(self):
+        self.load()
+        super().clear()
+
+    def delete(self):
+        self._loaded = True
+        super().delete()
+
+    def save(self):
+        # unchanged, unless it has been loaded and modified
+        if self._loaded:
+            super().save()
@@ -0,0 +1,158 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2026 Anggit Arfanto
+
+import asyncio
+import json
+import os
+import threading
+import time
+
+from collections import deque
+
+from .recorder import hash_id
+
+__all__ = ['AuditLog']
+
+
+class AuditLog:
+    """Records the ``login()``, ``logout()`` and ``delete()`` events
+    as JSON lines, e.g.
+    ``{"time": 1700000000.123, "event": "login", "id": "..."}``.
+
+    The events are buffered in memory and written in batches by a task
+    that runs in the executor, so there is no I/O in the request path.
+
+    :param path: The log file. It is rotated to ``path.1``, ``path.2``,
+        etc. when it reaches ``max_bytes``
+    :param buffer_size: The maximum number of events waiting to be written
+    :param flush_interval: In seconds
+    :param max_bytes: ``0`` never rotates
+    :param backup_count: The number of rotated files to keep
+    :param policy: What to do with an event when the buffer is full.
+        ``'drop'`` discards it and counts it in ``dropped``. ``'block'``
+        writes the buffer right away, in the request path.
+    :param hash_ids: Record a hash of the session id instead of the id,
+        which would be enough to take over the session
+    """
+
+    def __init__(self, path, buffer_size=10000, flush_interval=1,
+                 max_bytes=10485760, backup_count=5, policy='drop',
+                 hash_ids=True):
+        if policy not in ('drop', 'block'):
+            raise ValueError('policy must be either "drop" or "block"')
+
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.policy = policy
+        self.hash_ids = hash_ids
+        self.dropped = 0
+
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._logger = None
+        self._task = None
+
+    def __getstate__(self):
+        # the app is pickled to spawn the workers. each gets its own lock,
+        # the executor, the logger and the task are set on start
+        state = self.__dict__.copy()
+
+        for name in ('_lock', '_executor', '_logger', '_task'):
+            del state[name]
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._logger = None
+        self._task = None
+
+    def emit(self, event, session_id):
+        if len(self._buffer) >= self.buffer_size:
+            if self.policy == 'drop':
+                self.dropped += 1
+                return
+
+            self.flush()
+
+        if self.hash_ids:
+            session_id = hash_id(session_id)
+
+        self._buffer.append(json.dumps({
+            'time': round(time.time(), 3),
+            'event': event,
+            'id': session_id
+        }) + '\n')
+
+    def flush(self):
+        with self._lock:
+            lines = []
+
+            while self._buffer:
+                lines.append(self._buffer.popleft())
+
+            if not lines:
+                return
+
+            try:
+                with open(self.path, 'a') as fp:
+                    fp.write(''.join(lines))
+                    size = fp.tell()
+            except OSError:
+                # back in front, in order. they are written on the next flush
+                self._buffer.extendleft(reversed(lines))
+                raise
+
+            if self.max_bytes and size >= self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            filepath = '%s.%d' % (self.path, i)
+
+            if os.path.exists(filepath):
+                os.replace(filepath, '%s.%d' % (self.path, i + 1))
+
+        if self.backup_count > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.unlink(self.path)
+
+    async def start(self, globals=None, loop=None, logger=None, **_):
+        self._executor = getattr(globals, 'executor', None)
+        self._logger = logger
+
+        if self._task is None:
+            self._task = (loop or asyncio.get_event_loop()).create_task(
+                self._flush_periodically()
+            )
+
+    async def stop(self, **_):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        self.flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            if not self._buffer:
+                continue
+
+            try:
+                if self._executor is None:
+                    self.flush()
+                else:
+                    await self._executor.submit(self.flush)
+            except OSError as exc:
+                # e.g. a full disk. the events are kept, try again later
+                if self._logger is not None:
+                    self._logger.error('cannot write the audit log: %s', exc)
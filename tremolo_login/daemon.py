@@ -0,0 +1,268 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2026 Anggit Arfanto
+
+"""A small session server that holds the sessions in memory and is shared
+by all workers on a host, over a Unix domain socket.
+
+Run it with ``python3 -m tremolo_login.daemon --path /tmp/tremolo-sess.sock``
+and use ``SocketStore('/tmp/tremolo-sess.sock')`` as the ``Session`` store.
+
+This module is only the entry point, it is not imported by the package.
+The protocol is described in ``tremolo_login.protocol``.
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import struct
+import subprocess  # nosec B404
+import sys
+
+from collections import OrderedDict
+from itertools import count
+
+from .protocol import (
+    OP_GET,
+    OP_SET,
+    OP_DELETE,
+    OP_EXISTS,
+    OP_VERSION,
+    STATUS_OK,
+    STATUS_NOT_FOUND,
+    STATUS_ERROR,
+    FRAME,
+    MAX_FRAME_SIZE,
+    unpack_commands,
+    pack_replies,
+    write_snapshot,
+    read_snapshot
+)
+from .utils import now, get_exp_time
+
+
+class SessionServer:
+    """Holds the sessions as encoded bytes, in LRU order.
+    Entries expire at the time encoded in their session id.
+
+    With ``snapshot_path``, the sessions are restored from it on start,
+    written to it every ``snapshot_interval`` seconds in a thread,
+    and once more on exit.
+    """
+
+    def __init__(self, path, maxsize=1000000, sweep_interval=60,
+                 snapshot_path=None, snapshot_interval=300):
+        self.path = path
+        self.maxsize = maxsize
+        self.sweep_interval = sweep_interval
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+
+        self._data = OrderedDict()
+        self._versions = count(1)
+
+    def get(self, session_id):
+        entry = self._data.get(session_id)
+
+        if entry is None:
+            return
+
+        if now() > entry[0]:
+            del self._data[session_id]
+            return
+
+        self._data.move_to_end(session_id)
+        return entry
+
+    def execute(self, op, key, value):
+        if op == OP_GET or op == OP_EXISTS or op == OP_VERSION:
+            entry = self.get(key)
+
+            if entry is None:
+                return STATUS_NOT_FOUND, b''
+
+            if op == OP_GET:
+                return STATUS_OK, entry[2]
+
+            if op == OP_VERSION:
+                return STATUS_OK, b'%d' % entry[1]
+
+            return STATUS_OK, b''
+
+        if op == OP_SET:
+            try:
+                expires = get_exp_time(key)
+            except ValueError:
+                return STATUS_ERROR, b'invalid session id'
+
+            self._data[key] = (expires, next(self._versions), value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+            return STATUS_OK, b''
+
+        if op == OP_DELETE:
+            if self._data.pop(key, None) is None:
+                return STATUS_NOT_FOUND, b''
+
+            return STATUS_OK, b''
+
+        return STATUS_ERROR, b'unknown op'
+
+    def sweep(self):
+        """Removes the expired entries. Returns the number of them."""
+        timestamp = now()
+        expired = [k for k, v in self._data.items() if timestamp > v[0]]
+
+        for session_id in expired:
+            del self._data[session_id]
+
+        return len(expired)
+
+    def restore(self):
+        """Loads the snapshot. Returns the number of sessions."""
+        restored = 0
+
+        for batch in read_snapshot(self.snapshot_path):
+            for session_id, expires, value in batch:
+                self._data[session_id] = (expires, next(self._versions),
+                                          value)
+                self._data.move_to_end(session_id)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+            restored += len(batch)
+
+        return restored
+
+    async def snapshot(self):
+        # the values are immutable bytes, a shallow copy is consistent
+        items = [(k, v[2]) for k, v in self._data.items()]
+
+        return await asyncio.get_event_loop().run_in_executor(
+            None, write_snapshot, self.snapshot_path, items
+        )
+
+    async def _sweep_periodically(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
+
+    async def _snapshot_periodically(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            await self.snapshot()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(FRAME.size)
+                size, = FRAME.unpack(header)
+
+                if size > MAX_FRAME_SIZE:
+                    break
+
+                body = await reader.readexactly(size)
+                writer.write(pack_replies(
+                    self.execute(*command)
+                    for command in unpack_commands(body)
+                ))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, struct.error):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        if self.snapshot_path:
+            self.restore()
+
+        server = await asyncio.start_unix_server(self.handle, self.path)
+        os.chmod(self.path, 0o600)
+
+        if self.snapshot_path and self.snapshot_interval > 0:
+            task = asyncio.ensure_future(self._snapshot_periodically())
+        else:
+            task = None
+
+        try:
+            if self.sweep_interval > 0:
+                await self._sweep_periodically()
+            else:
+                # until cancelled
+                await asyncio.get_event_loop().create_future()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+            if task is not None:
+                task.cancel()
+
+            if self.snapshot_path:
+                write_snapshot(self.snapshot_path,
+                               ((k, v[2]) for k, v in self._data.items()))
+
+
+def spawn(path, **kwargs):
+    """Starts the daemon in the background and returns the process.
+
+    It is intended to be called once, by the main process, before
+    ``app.run()``. The keyword arguments are passed as the options,
+    they are those of ``SessionServer``: ``maxsize``, ``sweep_interval``,
+    ``snapshot_path`` and ``snapshot_interval``.
+    """
+    args = [sys.executable, '-m', 'tremolo_login.daemon', '--path', path]
+
+    for name, value in kwargs.items():
+        if name not in ('maxsize', 'sweep_interval', 'snapshot_path',
+                        'snapshot_interval'):
+            raise TypeError(
+                "spawn() got an unexpected keyword argument '%s'" % name
+            )
+
+        args.extend(('--' + name.replace('_', '-'), str(value)))
+
+    return subprocess.Popen(args)  # nosec B603
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='A shared, in-memory session server for tremolo-login.'
+    )
+    parser.add_argument('--path', default='/tmp/tremolo-sess.sock')  # nosec
+    parser.add_argument('--maxsize', type=int, default=1000000)
+    parser.add_argument('--sweep-interval', type=float, default=60)
+    parser.add_argument('--snapshot-path', '--snapshot',
+                        help='path to the snapshot file')
+    parser.add_argument('--snapshot-interval', type=float, default=300)
+    args = parser.parse_args()
+
+    server = SessionServer(args.path, maxsize=args.maxsize,
+                           sweep_interval=args.sweep_interval,
+                           snapshot_path=args.snapshot_path,
+                           snapshot_interval=args.snapshot_interval)
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(server.serve())
+
+    loop.add_signal_handler(signal.SIGINT, task.cancel)
+    loop.add_signal_handler(signal.SIGTERM, task.cancel)
+
+    try:
+        loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
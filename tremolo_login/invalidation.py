@@ -0,0 +1,146 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2026 Anggit Arfanto
+
+import asyncio
+import os
+import socket
+import time
+
+from collections import OrderedDict
+from itertools import count
+
+__all__ = ['Invalidator']
+
+
+class Invalidator:
+    """Tells the other workers on the host which sessions have changed,
+    so they can evict them from their caches.
+
+    Each worker binds a Unix datagram socket in the ``path`` directory,
+    and a change is sent to all the sockets there, except its own.
+    Delivery is best-effort: if a worker is too far behind to receive,
+    the message to it is dropped.
+
+    :param path: A directory shared by the workers, e.g.
+        ``/tmp/tremolo-sess-inval``. It is created if it doesn't exist.
+    :param maxsize: The number of recently invalidated ids to remember,
+        for ``generation()``
+    :param refresh_interval: How often the list of the other workers is
+        read again, in seconds. A worker that has just started may miss
+        the changes made in between.
+    """
+
+    def __init__(self, path, maxsize=10000, refresh_interval=1):
+        self.path = path
+        self.maxsize = maxsize
+        self.refresh_interval = refresh_interval
+
+        self._sock = None
+        self._sockpath = None
+        self._peers = []
+        self._peers_expire = 0
+        self._loop = None
+        self._callbacks = []
+        self._generations = OrderedDict()
+        self._floor = 0
+        self._counter = count(1)
+
+    def subscribe(self, callback):
+        """Calls ``callback(session_id)`` when another worker changes
+        or deletes the session.
+        """
+        self._callbacks.append(callback)
+
+    def generation(self, session_id):
+        """Returns a number that changes every time the session is
+        invalidated by another worker.
+        """
+        # forgotten ids get the highest generation that was forgotten,
+        # it never equals an older one that was handed out for them
+        return self._generations.get(session_id, self._floor)
+
+    async def start(self, loop=None, **_):
+        if self._sock is not None:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # there can be more than one per worker, e.g. one per store
+        self._sockpath = os.path.join(
+            self.path, '%d-%x.sock' % (os.getpid(), id(self))
+        )
+
+        if os.path.exists(self._sockpath):
+            os.unlink(self._sockpath)  # left by a crashed worker
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._sock.bind(self._sockpath)
+
+        self._loop = loop or asyncio.get_event_loop()
+        self._loop.add_reader(self._sock.fileno(), self._receive)
+        self._peers_expire = 0
+
+    async def stop(self, **_):
+        if self._sock is None:
+            return
+
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+
+        try:
+            os.unlink(self._sockpath)
+        except FileNotFoundError:
+            pass
+
+    def publish(self, session_id):
+        if self._sock is None:
+            return
+
+        message = session_id.encode('latin-1')
+
+        for peer in self._get_peers():
+            try:
+                self._sock.sendto(message, peer)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # a worker that is gone, maybe without cleaning up
+                try:
+                    os.unlink(peer)
+                except OSError:
+                    pass
+
+                self._peers_expire = 0
+            except OSError:
+                continue  # e.g. its receive buffer is full
+
+    def _get_peers(self):
+        # not listed on every change, that is a directory read per save
+        timestamp = time.monotonic()
+
+        if timestamp >= self._peers_expire:
+            me = os.path.basename(self._sockpath)
+            self._peers = [os.path.join(self.path, name)
+                           for name in os.listdir(self.path)
+                           if name.endswith('.sock') and name != me]
+            self._peers_expire = timestamp + self.refresh_interval
+
+        return self._peers
+
+    def _receive(self):
+        while True:
+            try:
+                message = self._sock.recv(256)
+            except (BlockingIOError, InterruptedError):
+                return
+
+            session_id = message.decode('latin-1')
+
+            self._generations[session_id] = next(self._counter)
+            self._generations.move_to_end(session_id)
+
+            while len(self._generations) > self.maxsize:
+                _, self._floor = self._generations.popitem(last=False)
+
+            for callback in self._callbacks:
+                callback(session_id)
@@ -0,0 +1,165 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2026 Anggit Arfanto
+
+"""The binary protocol of the session daemon, and its snapshot files.
+
+Each frame is a 4-byte length followed by one or more commands
+(batching), and a client may send several frames before reading the
+replies (pipelining). The replies come back in order.
+
+Command: ``op (1 byte) | key length (1 byte) | key | value length (4 bytes)
+| value``
+
+Reply: ``status (1 byte) | value length (4 bytes) | value``
+
+A snapshot file is a sequence of frames of ``OP_SET`` commands.
+"""
+
+import os
+import struct
+
+from .utils import now, get_exp_time
+
+OP_GET = 1
+OP_SET = 2
+OP_DELETE = 3
+OP_EXISTS = 4
+OP_VERSION = 5
+
+STATUS_OK = 0
+STATUS_NOT_FOUND = 1
+STATUS_ERROR = 2
+
+FRAME = struct.Struct('!I')
+COMMAND = struct.Struct('!BB')
+REPLY = struct.Struct('!BI')
+
+MAX_FRAME_SIZE = 64 * 1048576
+
+
+def pack_commands(commands):
+    """Packs an iterable of ``(op, key, value)`` into a single frame."""
+    body = bytearray()
+
+    for op, key, value in commands:
+        key = key.encode('latin-1')
+        body.extend(COMMAND.pack(op, len(key)))
+        body.extend(key)
+        body.extend(FRAME.pack(len(value)))
+        body.extend(value)
+
+    return FRAME.pack(len(body)) + body
+
+
+def unpack_commands(body):
+    i = 0
+
+    while i < len(body):
+        op, key_size = COMMAND.unpack_from(body, i)
+        i += COMMAND.size
+        key = bytes(body[i:i + key_size]).decode('latin-1')
+        i += key_size
+        value_size, = FRAME.unpack_from(body, i)
+        i += FRAME.size
+
+        yield op, key, bytes(body[i:i + value_size])
+        i += value_size
+
+
+def pack_replies(replies):
+    body = bytearray()
+
+    for status, value in replies:
+        body.extend(REPLY.pack(status, len(value)))
+        body.extend(value)
+
+    return FRAME.pack(len(body)) + body
+
+
+def unpack_replies(body):
+    i = 0
+
+    while i < len(body):
+        status, value_size = REPLY.unpack_from(body, i)
+        i += REPLY.size
+
+        yield status, bytes(body[i:i + value_size])
+        i += value_size
+
+
+def write_snapshot(path, items, batch_size=1000):
+    """Writes an iterable of ``(session_id, value)`` to ``path``,
+    in order, skipping the expired ones. Returns the number written.
+
+    The file is replaced atomically, a reader never sees a partial one.
+    """
+    timestamp = now()
+    filepath = '%s.%d.tmp' % (path, os.getpid())
+    batch = []
+    written = 0
+
+    with open(filepath, 'wb') as fp:
+        for session_id, value in items:
+            try:
+                if timestamp > get_exp_time(session_id[:8]):
+                    continue
+            except ValueError:
+                continue
+
+            batch.append((OP_SET, session_id, value))
+
+            if len(batch) >= batch_size:
+                fp.write(pack_commands(batch))
+                written += len(batch)
+                batch.clear()
+
+        if batch:
+            fp.write(pack_commands(batch))
+            written += len(batch)
+
+    os.replace(filepath, path)
+    return written
+
+
+def read_snapshot(path):
+    """Yields lists of ``(session_id, expires, value)`` from a snapshot,
+    one list per frame, skipping the expired ones.
+    Yields nothing if there is none.
+    """
+    timestamp = now()
+
+    try:
+        fp = open(path, 'rb')
+    except FileNotFoundError:
+        return
+
+    with fp:
+        while True:
+            header = fp.read(FRAME.size)
+
+            if len(header) < FRAME.size:
+                break
+
+            size, = FRAME.unpack(header)
+
+            if size > MAX_FRAME_SIZE:
+                break
+
+            body = fp.read(size)
+
+            if len(body) < size:
+                break
+
+            batch = []
+
+            for op, session_id, value in unpack_commands(body):
+                try:
+                    # 8 characters are enough to decode the first 4 bytes
+                    expires = get_exp_time(session_id[:8])
+                except ValueError:
+                    continue
+
+                if op == OP_SET and expires >= timestamp:
+                    batch.append((session_id, expires, value))
+
+            yield batch
@@ -0,0 +1,108 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2026 Anggit Arfanto
+
+import hashlib
+import json
+import time
+
+__all__ = ['TraceRecorder', 'read_trace']
+
+
+def hash_id(session_id):
+    # session ids are random enough that an unkeyed hash can't be reversed
+    return hashlib.blake2b(session_id.encode('latin-1'),
+                           digest_size=8).hexdigest()
+
+
+def get_size(data):
+    try:
+        return len(json.dumps(data)) if data else 0
+    except (TypeError, ValueError):
+        return -1
+
+
+def read_trace(path):
+    """Yields the records of a trace file, as dicts."""
+    with open(path) as fp:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+
+class Record:
+    __slots__ = ('recorder', 'fields')
+
+    def __init__(self, recorder, fields):
+        self.recorder = recorder
+        self.fields = fields
+
+    def finish(self, written=None):
+        self.fields['written'] = get_size(written)
+        self.recorder.write(self.fields)
+
+
+class TraceRecorder:
+    """Records the session-relevant metadata of each request, as JSON lines,
+    for ``benchmarks/replay.py``. No session ids or payloads are recorded,
+    only a hash of the id and the payload sizes.
+
+    Each record has the time ``t``, ``path``, ``match`` (whether the path
+    is in the scope of the session), ``auth`` (``'cookie'``,
+    ``'authorization'`` or ``None``), ``id``, ``new`` (whether the id was
+    minted by this request), and the ``read`` and ``written`` JSON sizes.
+
+    :param path: The trace file. Records are appended to it
+    :param buffer_size: The number of records to buffer before writing
+    :param path_depth: If set, only keep this many url path segments
+    """
+
+    def __init__(self, path, buffer_size=100, path_depth=None):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.path_depth = path_depth
+
+        self._buffer = []
+
+    def _get_path(self, path):
+        path = path.decode('latin-1')
+
+        if self.path_depth is not None:
+            path = '/'.join(path.split('/')[:self.path_depth + 1])
+
+        return path
+
+    def start(self, path, auth=None, session_id=None, data=None, new=False,
+              match=True):
+        return Record(self, {
+            't': round(time.time(), 3),
+            'path': self._get_path(path),
+            'match': match,
+            'auth': auth,
+            'id': session_id and hash_id(session_id),
+            'new': new,
+            'read': get_size(data),
+            'written': 0
+        })
+
+    def record(self, path, **kwargs):
+        self.start(path, **kwargs).finish()
+
+    def write(self, fields):
+        self._buffer.append(json.dumps(fields) + '\n')
+
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+
+        lines = ''.join(self._buffer)
+        self._buffer.clear()
+
+        # a single append per batch, so workers can share the file
+        with open(self.path, 'a') as fp:
+            fp.write(lines)
+
+    async def stop(self, **_):
+        self.flush()
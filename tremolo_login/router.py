@@ -0,0 +1,92 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2026 Anggit Arfanto
+
+__all__ = ['SessionRouter']
+
+
+class SessionRouter:
+    """Dispatches each request to one of several ``Session`` instances.
+
+    Instead of every instance registering its own middleware and walking
+    the url path, the router registers once, builds a single index over
+    the ``paths`` of all instances, and dispatches to the one with the
+    longest matching prefix, e.g. ``/admin/users`` before ``/admin``.
+    An instance without ``paths`` is the default. The same prefix can't
+    be used by two instances.
+
+    Usage::
+
+        router = SessionRouter(app)
+
+        Session(router, name='admin', paths=('/admin',))
+        Session(router, name='api', paths=('/api',))
+        Session(router, name='sess')
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.sessions = []
+
+        self._index = {}
+        self._default = None
+
+        app.add_middleware(self._on_request, 'request')
+        app.add_middleware(self._on_response, 'response')
+
+    def add_hook(self, *args, **kwargs):
+        return self.app.add_hook(*args, **kwargs)
+
+    def add(self, sess):
+        if not sess.paths:
+            if self._default is not None:
+                raise ValueError('only one session can match all paths')
+
+            self._default = sess
+
+        for path in sess.paths:
+            if path in self._index:
+                raise ValueError(
+                    'path prefix %s is already used by session %s' %
+                    (path.decode('latin-1') or '/',
+                     self._index[path].name)
+                )
+
+        for path in sess.paths:
+            self._index[path] = sess
+
+        self.sessions.append(sess)
+
+    def match(self, path):
+        if not self._index:
+            return self._default  # nothing to walk
+
+        path = path.rstrip(b'/')
+        depth = 0
+
+        while depth < 255:
+            if path in self._index:
+                return self._index[path]
+
+            end = path.rfind(b'/')
+
+            if end == -1:
+                return self._default
+
+            path = path[:end]
+            depth += 1
+
+        # too deep, no session, like Session does on its own
+
+    async def _on_request(self, request, response, **server):
+        request.ctx.session = None
+        sess = self.match(request.path)
+
+        if sess is not None:
+            trace = sess._trace()
+            trace.mark('match')
+
+            await sess._handle(request, response, trace, **server)
+
+    async def _on_response(self, request, **server):
+        if request.ctx.session is not None:
+            await request.ctx.session._sess._on_response(request, **server)
@@ -0,0 +1,1815 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2023 Anggit Arfanto
+
+import asyncio
+import hashlib
+import heapq
+import json
+import os
+import queue
+import shutil
+import socket
+import threading
+import time
+
+from bisect import bisect
+from collections import OrderedDict
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+
+from tremolo.exceptions import PayloadTooLarge, ServiceUnavailable
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from . import protocol
+from .utils import now, get_exp_time
+
+__all__ = ['FileStore', 'MemoryStore', 'TieredStore', 'SocketStore',
+           'BoundedStore', 'HashRing']
+
+# on Windows, a file can't be replaced while another thread has it open,
+# e.g. to read it. the delays in seconds before each retry
+_REPLACE_RETRY_DELAYS = ((0.001, 0.005, 0.02, 0.1, 0.25) if os.name == 'nt'
+                         else ())
+
+
+def _replace(src, dst):
+    for delay in _REPLACE_RETRY_DELAYS:
+        try:
+            os.replace(src, dst)
+            return
+        except PermissionError:
+            time.sleep(delay)
+
+    os.replace(src, dst)
+
+
+# the stores that don't provide the batched operations
+# are called once per session
+
+def _get_many(store, session_ids):
+    if hasattr(store, 'get_many'):
+        return store.get_many(session_ids)
+
+    items = {}
+
+    for session_id in session_ids:
+        data = store.get(session_id)
+
+        if data is not None:
+            items[session_id] = data
+
+    return items
+
+
+def _set_many(store, items):
+    if hasattr(store, 'set_many'):
+        store.set_many(items)
+        return
+
+    for session_id, data in items.items():
+        store.set(session_id, data)
+
+
+def _delete_many(store, session_ids):
+    if hasattr(store, 'delete_many'):
+        return store.delete_many(session_ids)
+
+    return sum(store.delete(session_id) for session_id in session_ids)
+
+
+class HashRing:
+    """A consistent hash ring. Adding a node only moves about ``1/n``
+    of the keys to it, the rest stay where they are.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        self.replicas = replicas
+
+        self._ring = sorted(
+            (self._hash('%s#%d' % (node, i)), node)
+            for node in self.nodes for i in range(replicas)
+        )
+        self._keys = [item[0] for item in self._ring]
+
+    def _hash(self, key):
+        return int.from_bytes(
+            hashlib.blake2b(key.encode('latin-1'), digest_size=8).digest(),
+            byteorder='big'
+        )
+
+    def get(self, key):
+        i = bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._ring[i][1]
+
+
+class FileStore:
+    """Stores each session as a JSON file, named after its session id.
+
+    :param path: A directory path, or a list of them. E.g. one per disk.
+        The sessions are spread across them by consistent hashing
+        of the session id.
+    :param split_auth: Write the login state (``sid``) on the first line,
+        followed by the rest of the session. So ``get_auth()`` doesn't
+        need to read and decode the whole session.
+    :param bucket_size: If set, the session files are grouped into
+        subdirectories by their expiration time, one per ``bucket_size``
+        seconds. E.g. ``3600`` for hourly buckets. ``sweep()`` can then
+        remove the expired sessions a whole directory at a time.
+    :param sweep_interval: Call ``sweep()`` every ``sweep_interval``
+        seconds, in the executor, while the worker is running.
+    :param delta: Only append the changed keys to the session file
+        on ``update()``, instead of rewriting the whole session.
+    :param compact_after: With ``delta``, rewrite the whole session
+        after this many appended changes.
+    :param max_workers: The number of threads that ``get_many()``,
+        ``set_many()`` and ``delete_many()`` spread the sessions over.
+    """
+
+    # the operations touch the disk,
+    # reads will be performed in the worker thread pool
+    blocking = True
+
+    # at the class level, an instance must stay picklable
+    _pool_lock = threading.Lock()
+
+    def __init__(self, path, split_auth=False, bucket_size=None,
+                 sweep_interval=0, delta=False, compact_after=32,
+                 max_workers=8):
+        self.split_auth = split_auth
+        self.bucket_size = bucket_size
+        self.sweep_interval = sweep_interval
+        self.delta = delta
+        self.compact_after = compact_after
+        self.max_workers = max_workers
+
+        self._executor = None
+        self._task = None
+        self._pool = None
+
+        # the number of changes appended to each session file, as last
+        # seen by this worker. it is only a hint for the compaction
+        self._patches = {}
+
+        if isinstance(path, str):
+            self.paths = [path]
+        else:
+            self.paths = list(path)
+
+        for path in self.paths:
+            if not os.path.isdir(path):
+                os.makedirs(path, exist_ok=True)
+
+        if len(self.paths) == 1:
+            self.path = self.paths[0]
+            self._ring = None
+        else:
+            self.path = self.paths
+            self._ring = HashRing(self.paths)
+
+    def filepath(self, session_id):
+        if self._ring is None:
+            path = self.path
+        else:
+            path = self._ring.get(session_id)
+
+        if self.bucket_size:
+            # 8 characters are enough to decode the expiration time
+            return os.path.join(path, '%d' % (
+                get_exp_time(session_id[:8]) // self.bucket_size
+            ), session_id)
+
+        return os.path.join(path, session_id)
+
+    def _scan(self, deadline=None, low=0, high=0xffffffff):
+        # the session files, both at the top level and in the buckets.
+        # so changing the layout only needs a rebalance().
+        # the buckets entirely outside of the expiration times
+        # from low to high are skipped
+        for path in self.paths:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if deadline is not None and time.monotonic() > deadline:
+                        return
+
+                    if entry.name.isdigit() and entry.is_dir():
+                        if self.bucket_size and not (
+                                low // self.bucket_size <= int(entry.name) <=
+                                high // self.bucket_size):
+                            continue
+
+                        try:
+                            with os.scandir(entry.path) as bucket:
+                                yield from bucket
+                        except FileNotFoundError:
+                            continue  # swept meanwhile
+                    else:
+                        yield entry
+
+    def scan(self, expires_after=None, expires_before=None, logged_in=None):
+        """Yields ``(session_id, expires, data)`` of the stored sessions,
+        one at a time, in no particular order.
+
+        The expiration times are taken from the file names, and whole
+        buckets are skipped in the bucketed layout. With ``logged_in``,
+        only the login state is read to filter, e.g. the first line
+        with ``split_auth``.
+
+        :param expires_after: Defaults to now, i.e. not expired
+        :param expires_before: Defaults to no limit
+        :param logged_in: ``True`` or ``False`` to only yield the sessions
+            with or without a ``sid``
+        """
+        low = now() if expires_after is None else expires_after
+        high = 0xffffffff if expires_before is None else expires_before
+
+        for entry in self._scan(low=low, high=high):
+            if '.' in entry.name:
+                continue
+
+            try:
+                expires = get_exp_time(entry.name[:8])
+            except ValueError:
+                continue
+
+            if not low <= expires <= high:
+                continue
+
+            try:
+                if logged_in is not None:
+                    auth = self.get_auth(entry.name)
+
+                    if auth is None or bool(auth.get('sid')) != logged_in:
+                        continue
+
+                data = self.get(entry.name)
+            except OSError:
+                continue  # deleted meanwhile
+
+            if data is not None:
+                yield entry.name, expires, data
+
+    def sizes(self):
+        """Yields ``(session_id, expires, size)`` of the sessions that are
+        not expired, without reading them. The size is that of the file.
+        """
+        low = now()
+
+        for entry in self._scan(low=low):
+            if '.' in entry.name:
+                continue
+
+            try:
+                expires = get_exp_time(entry.name[:8])
+            except ValueError:
+                continue
+
+            if expires < low:
+                continue
+
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                continue  # deleted meanwhile
+
+            yield entry.name, expires, size
+
+    def sweep(self):
+        """Removes the expired sessions. Returns the number of them.
+
+        In the bucketed layout, the buckets whose whole window has expired
+        are removed at once, without looking at the sessions in them.
+        """
+        timestamp = now()
+        removed = 0
+
+        for path in self.paths:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name.isdigit() and entry.is_dir():
+                        if (self.bucket_size and timestamp >=
+                                (int(entry.name) + 1) * self.bucket_size):
+                            shutil.rmtree(entry.path, ignore_errors=True)
+                            removed += 1
+
+                        continue
+
+                    if '.' in entry.name:
+                        continue
+
+                    try:
+                        if timestamp > get_exp_time(entry.name):
+                            os.unlink(entry.path)
+                            removed += 1
+                    except (OSError, ValueError):
+                        continue
+
+        return removed
+
+    async def start(self, globals=None, loop=None, **_):
+        self._executor = getattr(globals, 'executor', None)
+
+        if self.sweep_interval > 0 and self._task is None:
+            self._task = (loop or asyncio.get_event_loop()).create_task(
+                self._sweep_periodically()
+            )
+
+    async def stop(self, **_):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    async def _sweep_periodically(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+
+            if self._executor is None:
+                self.sweep()
+            else:
+                await self._executor.submit(self.sweep)
+
+    def recent(self, n, deadline=None):
+        """Returns the ids of up to ``n`` most recently modified sessions
+        that have not expired, newest first. The expiration time is taken
+        from the file names, only the candidates are ``stat()``-ed.
+
+        It stops scanning at ``deadline``, a ``time.monotonic()`` value.
+        """
+        timestamp = now()
+        items = []
+
+        for entry in self._scan(deadline):
+            if '.' in entry.name:
+                continue
+
+            try:
+                if timestamp > get_exp_time(entry.name):
+                    continue
+
+                items.append((entry.stat().st_mtime, entry.name))
+            except (OSError, ValueError):
+                continue
+
+        return [name for _, name in heapq.nlargest(n, items)]
+
+    def rebalance(self):
+        """Moves the session files that are not in their directory, e.g.
+        after a directory was added to the list, or ``bucket_size`` was
+        changed. Returns the number of moved files.
+
+        Sessions are not found while they are being moved,
+        so this is better done before the workers start.
+        """
+        moved = 0
+
+        # collected first, the moves would show up in the scan otherwise
+        for entry in list(self._scan()):
+            if not entry.is_file() or '.' in entry.name:
+                continue  # temporary files, etc.
+
+            try:
+                filepath = self.filepath(entry.name)
+            except ValueError:
+                continue
+
+            if filepath != entry.path:
+                os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                shutil.move(entry.path, filepath)
+                moved += 1
+
+        return moved
+
+    def version(self, session_id):
+        try:
+            st = os.stat(self.filepath(session_id))
+        except OSError:
+            return
+
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def exists(self, session_id):
+        return os.path.exists(self.filepath(session_id))
+
+    def _open(self, session_id):
+        filepath = self.filepath(session_id)
+
+        if not os.path.isfile(filepath):
+            return
+
+        if now() > get_exp_time(session_id):
+            os.unlink(filepath)
+            return
+
+        return open(filepath, 'r')
+
+    def _decode(self, session_id, line, data):
+        if line.startswith('{'):  # a plain JSON session
+            data = line + data
+            sid = ''
+        else:
+            sid = line.rstrip('\n')
+
+        # the session, possibly followed by the appended changes,
+        # one per line
+        lines = data.split('\n')
+
+        try:
+            result = json.loads(lines[0])
+
+            for i, patch in enumerate(lines[1:], 1):
+                try:
+                    changed, removed = json.loads(patch)
+                except ValueError:
+                    if i < len(lines) - 1:
+                        raise
+
+                    break  # still being appended
+
+                result.update(changed)
+
+                for key in removed:
+                    result.pop(key, None)
+        except ValueError:
+            os.unlink(self.filepath(session_id))
+            return
+
+        if self.delta:
+            if len(self._patches) > 100000:
+                self._patches.clear()
+
+            self._patches[session_id] = len(lines) - 1
+
+        if sid:
+            result['sid'] = sid
+
+        return result
+
+    def get(self, session_id):
+        fp = self._open(session_id)
+
+        if fp is None:
+            return
+
+        with fp:
+            return self._decode(session_id, fp.readline(), fp.read())
+
+    def get_auth(self, session_id):
+        """Returns only the login state, e.g. ``{'sid': ...}``,
+        or ``None`` if the session doesn't exist.
+        """
+        fp = self._open(session_id)
+
+        if fp is None:
+            return
+
+        with fp:
+            line = fp.readline()
+
+            if line.startswith('{'):
+                # the changes that follow never touch the sid
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    os.unlink(self.filepath(session_id))
+                    return
+            else:
+                data = {'sid': line.rstrip('\n')}
+
+        if data.get('sid'):
+            return {'sid': data['sid']}
+
+        return {}
+
+    def set(self, session_id, data):
+        filepath = self.filepath(session_id)
+
+        # write to a temporary file, then atomically replace the old one.
+        # so a concurrent reader never sees a partially written session.
+        # one per thread, as the thread pools may write the same session
+        tmp = '%s.%d-%d.tmp' % (filepath, os.getpid(), threading.get_ident())
+        sid = data.get('sid', '')
+
+        try:
+            fp = open(tmp, 'w')
+        except FileNotFoundError:
+            if not self.bucket_size:
+                raise
+
+            # the first session of this bucket
+            os.makedirs(os.path.dirname(tmp), exist_ok=True)
+            fp = open(tmp, 'w')
+
+        with fp:
+            if (self.split_auth and isinstance(sid, str) and
+                    '\n' not in sid and not sid.startswith('{')):
+                fp.write(sid + '\n')
+                json.dump({k: v for k, v in data.items() if k != 'sid'}, fp)
+            else:
+                json.dump(data, fp)
+
+        try:
+            _replace(tmp, filepath)
+        except OSError:
+            os.unlink(tmp)
+            raise
+
+        self._patches.pop(session_id, None)
+
+    def update(self, session_id, data, changed, removed):
+        """Saves a session of which only the ``changed`` keys and
+        the ``removed`` ones are different from the stored one.
+        With ``delta``, only those are written.
+        """
+        if not self._can_append(session_id, changed, removed):
+            self.set(session_id, data)
+            return
+
+        try:
+            # no O_CREAT, a new or deleted session is written in full
+            fd = os.open(self.filepath(session_id),
+                         os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            self.set(session_id, data)
+            return
+
+        try:
+            self._append(fd, session_id, changed, removed)
+        finally:
+            os.close(fd)
+
+    def _can_append(self, session_id, changed, removed):
+        return (self.delta and changed is not None and
+                'sid' not in changed and 'sid' not in removed and
+                self._patches.get(session_id, 0) < self.compact_after)
+
+    def _append(self, fd, session_id, changed, removed):
+        # a single write, so a reader sees either all of it or none,
+        # or a partial last line that is ignored
+        os.write(fd, ('\n' + json.dumps([changed, removed])).encode())
+        self._patches[session_id] = self._patches.get(session_id, 0) + 1
+
+    # without flock(), e.g. on Windows, the check and the write can't be
+    # made atomic. Session(cas=True) then saves as usual
+    if fcntl is not None:
+        def compare_and_set(self, session_id, data, version, changed=None,
+                            removed=None):
+            """Saves the session only if it is still at ``version``, i.e.
+            no one else has saved it since it was read. Returns the new
+            version, or ``None`` if it was changed or deleted meanwhile.
+
+            The session file is locked while it is compared and replaced,
+            so concurrent writers of the same session are serialized.
+            """
+            filepath = self.filepath(session_id)
+
+            try:
+                fd = os.open(filepath, os.O_WRONLY | os.O_APPEND)
+            except FileNotFoundError:
+                return
+
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+
+                st = os.fstat(fd)
+
+                # a writer that got the lock first may have replaced the file
+                if ((st.st_mtime_ns, st.st_size, st.st_ino) != version or
+                        os.stat(filepath).st_ino != st.st_ino):
+                    return
+
+                if self._can_append(session_id, changed, removed):
+                    self._append(fd, session_id, changed, removed)
+                else:
+                    self.set(session_id, data)
+
+                return self.version(session_id)
+            except FileNotFoundError:
+                return
+            finally:
+                os.close(fd)  # also releases the lock
+
+    def delete(self, session_id):
+        try:
+            os.unlink(self.filepath(session_id))
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def _map(self, func, items):
+        if len(items) < 2 or self.max_workers < 2:
+            return [func(item) for item in items]
+
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    # not the executor of the worker, which is async
+                    # and may be the one calling this
+                    self._pool = ThreadPoolExecutor(
+                        max_workers=self.max_workers
+                    )
+
+        # one chunk per thread, rather than a future per session
+        size = -(-len(items) // self.max_workers)
+        chunks = self._pool.map(
+            lambda chunk: [func(item) for item in chunk],
+            [items[i:i + size] for i in range(0, len(items), size)]
+        )
+
+        return [result for chunk in chunks for result in chunk]
+
+    def get_many(self, session_ids):
+        """Reads several sessions at once, on a bounded thread pool.
+        Returns a dict of the ones that exist.
+        """
+        session_ids = list(session_ids)
+
+        return {session_id: data for session_id, data in
+                zip(session_ids, self._map(self.get, session_ids))
+                if data is not None}
+
+    def set_many(self, items):
+        """Writes several sessions at once, on a bounded thread pool.
+
+        :param items: A dict, or an iterable of ``(session_id, data)``
+        """
+        # each id once, they would share the temporary file otherwise
+        self._map(lambda item: self.set(*item), list(dict(items).items()))
+
+    def delete_many(self, session_ids):
+        """Deletes several sessions at once, on a bounded thread pool.
+        Returns the number of them that existed.
+        """
+        return sum(self._map(self.delete, list(set(session_ids))))
+
+
+class MemoryStore:
+    """A bounded, in-memory LRU store.
+
+    Entries expire at the time encoded in their session id.
+    It is local to the worker process. The sessions are kept as JSON,
+    so each read returns a copy that the caller may change freely.
+
+    :param maxsize: The maximum number of sessions
+    :param snapshot_path: If set, the sessions are restored from a file
+        when the worker starts, written to it every ``snapshot_interval``
+        seconds in the executor, and once more when the worker stops.
+        Each worker locks the first free ``snapshot_path.0``,
+        ``snapshot_path.1``, etc., so the same files are found again
+        after a restart. Without ``flock()``, e.g. on Windows, it is
+        ``snapshot_path`` itself, for a single worker.
+    :param snapshot_interval: In seconds. ``0`` only writes on stop.
+    """
+
+    blocking = False
+
+    def __init__(self, maxsize=100000, snapshot_path=None,
+                 snapshot_interval=60):
+        self.maxsize = maxsize
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._versions = count(1)
+        self._executor = None
+        self._task = None
+        self._slot = None  # (path, fd) of the claimed snapshot file
+
+    def __getstate__(self):
+        # the app is pickled to spawn the workers. each gets its own lock,
+        # the executor, the task and the snapshot file are claimed on start
+        state = self.__dict__.copy()
+
+        for name in ('_lock', '_versions', '_executor', '_task', '_slot'):
+            del state[name]
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        # above the copied ones, a version is never handed out twice
+        self._versions = count(
+            max((entry[1] for entry in self._data.values()), default=0) + 1
+        )
+        self._executor = None
+        self._task = None
+        self._slot = None
+
+    def __len__(self):
+        return len(self._data)
+
+    def version(self, session_id):
+        entry = self._data.get(session_id)
+
+        if entry is not None:
+            return entry[1]
+
+    def exists(self, session_id):
+        return self.get(session_id) is not None
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._data.get(session_id)
+
+            if entry is None:
+                return
+
+            if now() > entry[0]:
+                del self._data[session_id]
+                return
+
+            self._data.move_to_end(session_id)
+            value = entry[2]
+
+        return json.loads(value)
+
+    def set(self, session_id, data):
+        entry = (get_exp_time(session_id), next(self._versions),
+                 json.dumps(data).encode('utf-8'))
+
+        with self._lock:
+            self._data[session_id] = entry
+            self._data.move_to_end(session_id)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def compare_and_set(self, session_id, data, version, changed=None,
+                        removed=None):
+        """See ``FileStore.compare_and_set()``."""
+        value = json.dumps(data).encode('utf-8')
+
+        with self._lock:
+            entry = self._data.get(session_id)
+
+            if entry is None or entry[1] != version:
+                return
+
+            entry = (entry[0], next(self._versions), value)
+            self._data[session_id] = entry
+            self._data.move_to_end(session_id)
+
+            return entry[1]
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._data.pop(session_id, None) is not None
+
+    def get_many(self, session_ids):
+        """See ``FileStore.get_many()``. The lock is taken only once."""
+        timestamp = now()
+        items = {}
+
+        with self._lock:
+            for session_id in session_ids:
+                entry = self._data.get(session_id)
+
+                if entry is None:
+                    continue
+
+                if timestamp > entry[0]:
+                    del self._data[session_id]
+                    continue
+
+                self._data.move_to_end(session_id)
+                items[session_id] = entry[2]
+
+        return {session_id: json.loads(value)
+                for session_id, value in items.items()}
+
+    def set_many(self, items):
+        """See ``FileStore.set_many()``."""
+        entries = [(session_id, (get_exp_time(session_id),
+                                 next(self._versions),
+                                 json.dumps(data).encode('utf-8')))
+                   for session_id, data in dict(items).items()]
+
+        with self._lock:
+            for session_id, entry in entries:
+                self._data[session_id] = entry
+                self._data.move_to_end(session_id)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete_many(self, session_ids):
+        """See ``FileStore.delete_many()``."""
+        with self._lock:
+            return sum(self._data.pop(session_id, None) is not None
+                       for session_id in set(session_ids))
+
+    def scan(self, expires_after=None, expires_before=None, logged_in=None):
+        """Yields ``(session_id, expires, data)`` of the sessions,
+        least recently used first. See ``FileStore.scan()``.
+        """
+        low = now() if expires_after is None else expires_after
+        high = 0xffffffff if expires_before is None else expires_before
+
+        with self._lock:
+            # only the ids are copied, not the sessions
+            session_ids = list(self._data)
+
+        for session_id in session_ids:
+            entry = self._data.get(session_id)
+
+            if entry is None or not low <= entry[0] <= high:
+                continue
+
+            data = json.loads(entry[2])
+
+            if logged_in is not None and bool(data.get('sid')) != logged_in:
+                continue
+
+            yield session_id, entry[0], data
+
+    def sizes(self):
+        """See ``FileStore.sizes()``. The size is that of the JSON."""
+        low = now()
+
+        with self._lock:
+            return [(session_id, entry[0], len(entry[2]))
+                    for session_id, entry in self._data.items()
+                    if entry[0] >= low]
+
+    def _claim_snapshot_path(self):
+        if self._slot is not None:
+            return self._slot[0]
+
+        if fcntl is None:
+            return self.snapshot_path
+
+        with self._lock:
+            for i in count():
+                path = '%s.%d' % (self.snapshot_path, i)
+                fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(fd)  # taken by another worker
+                    continue
+
+                self._slot = (path, fd)
+                return path
+
+    def _release_snapshot_path(self):
+        if self._slot is not None:
+            os.close(self._slot[1])  # also releases the lock
+            self._slot = None
+
+    def save_snapshot(self, path=None):
+        """Writes the sessions to ``path``, least recently used first.
+        Returns the number of them.
+        """
+        path = path or self._claim_snapshot_path()
+
+        with self._lock:
+            # the values are immutable bytes, a shallow copy is consistent
+            items = [(k, v[2]) for k, v in self._data.items()]
+
+        return protocol.write_snapshot(path, items)
+
+    def load_snapshot(self, path=None):
+        """Restores the sessions from ``path``. Returns the number of them.
+        """
+        loaded = 0
+
+        for batch in protocol.read_snapshot(
+                path or self._claim_snapshot_path()):
+            with self._lock:
+                for session_id, expires, value in batch:
+                    self._data[session_id] = (expires, next(self._versions),
+                                              value)
+                    self._data.move_to_end(session_id)
+
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+
+            loaded += len(batch)
+
+        return loaded
+
+    async def start(self, globals=None, loop=None, logger=None, **_):
+        if not self.snapshot_path:
+            return
+
+        self._executor = getattr(globals, 'executor', None)
+        started = time.monotonic()
+
+        if self._executor is None:
+            loaded = self.load_snapshot()
+        else:
+            loaded = await self._executor.submit(self.load_snapshot)
+
+        if logger is not None:
+            logger.info('restored %d sessions in %.2fms', loaded,
+                        (time.monotonic() - started) * 1000)
+
+        if self.snapshot_interval > 0 and self._task is None:
+            self._task = (loop or asyncio.get_event_loop()).create_task(
+                self._save_periodically()
+            )
+
+    async def stop(self, **_):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        if self.snapshot_path:
+            self.save_snapshot()
+            self._release_snapshot_path()
+
+    async def _save_periodically(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+
+            if self._executor is None:
+                self.save_snapshot()
+            else:
+                await self._executor.submit(self.save_snapshot)
+
+
+class TieredStore:
+    """A bounded, in-memory store (L1) in front of a durable store (L2).
+
+    :param l1: The in-memory store. E.g. ``MemoryStore(maxsize=100000)``
+    :param l2: The durable store. E.g. ``FileStore('/path/to/dir')``
+    :param write_policy: ``'write-through'`` writes to both tiers on every
+        save. ``'write-back'`` only writes to L1, the changes are flushed
+        to L2 in batches every ``flush_interval`` seconds
+        and when the worker stops.
+    :param warm_up: The number of the most recently modified sessions
+        to preload into L1 when the worker starts. It requires L2 to
+        provide ``recent()``, like ``FileStore``.
+    :param warm_up_budget: The maximum time spent warming up, in seconds.
+    :param invalidator: An ``Invalidator`` shared by the workers. The
+        sessions changed or deleted by a worker are then evicted from
+        the L1 of the others. With ``'write-back'``, the others may still
+        read the old session from L2 until the change is flushed.
+    """
+
+    def __init__(self, l1, l2, write_policy='write-through',
+                 flush_interval=1, warm_up=0, warm_up_budget=0.5,
+                 invalidator=None):
+        if write_policy not in ('write-through', 'write-back'):
+            raise ValueError('write_policy must be either '
+                             '"write-through" or "write-back"')
+
+        self.l1 = l1
+        self.l2 = l2
+        self.blocking = l2.blocking
+        self.write_policy = write_policy
+        self.flush_interval = flush_interval
+        self.warm_up = warm_up
+        self.warm_up_budget = warm_up_budget
+        self.invalidator = invalidator
+        self.hits = 0
+        self.misses = 0
+
+        if invalidator is not None:
+            invalidator.subscribe(l1.delete)
+
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._task = None
+
+    def __getstate__(self):
+        # see MemoryStore.__getstate__()
+        state = self.__dict__.copy()
+
+        for name in ('_lock', '_executor', '_task'):
+            del state[name]
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._task = None
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+
+        if total:
+            return self.hits / total
+
+        return 0.0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hit_ratio,
+            'size': len(self.l1),
+            'dirty': len(self._dirty)
+        }
+
+    async def start(self, globals=None, loop=None, logger=None, **_):
+        self._executor = getattr(globals, 'executor', None)
+
+        if self.invalidator is not None:
+            await self.invalidator.start(loop=loop)
+
+        for store in (self.l1, self.l2):
+            if hasattr(store, 'start'):
+                await store.start(globals=globals, loop=loop, logger=logger)
+
+        if self.warm_up > 0 and hasattr(self.l2, 'recent'):
+            started = time.monotonic()
+
+            if self._executor is None:
+                loaded = self.preload(self.warm_up, self.warm_up_budget)
+            else:
+                loaded = await self._executor.submit(
+                    self.preload, (self.warm_up, self.warm_up_budget)
+                )
+
+            if logger is not None:
+                logger.info('preloaded %d sessions in %.2fms', loaded,
+                            (time.monotonic() - started) * 1000)
+
+        if self.write_policy == 'write-back' and self._task is None:
+            self._task = (loop or asyncio.get_event_loop()).create_task(
+                self._flush_periodically()
+            )
+
+    async def stop(self, **_):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        self.flush()
+
+        for store in (self.l1, self.l2):
+            if hasattr(store, 'stop'):
+                await store.stop()
+
+        if self.invalidator is not None:
+            await self.invalidator.stop()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            if not self._dirty:
+                continue
+
+            if self._executor is None:
+                self.flush()
+            else:
+                await self._executor.submit(self.flush)
+
+    def preload(self, n, budget=0.5):
+        """Loads up to ``n`` most recently modified sessions from L2
+        into L1, within ``budget`` seconds. Returns the number of them.
+        """
+        deadline = time.monotonic() + budget
+        n = min(n, getattr(self.l1, 'maxsize', n))
+        items = []
+
+        # newest first, in case the budget runs out
+        for session_id in self.l2.recent(n, deadline):
+            if time.monotonic() > deadline:
+                break
+
+            data = self.l2.get(session_id)
+
+            if data is not None:
+                items.append((session_id, data))
+
+        # the newest should end up as the most recently used
+        for session_id, data in reversed(items):
+            self.l1.set(session_id, data)
+
+        return len(items)
+
+    def flush(self):
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = {}
+
+        if not dirty:
+            return
+
+        _set_many(self.l2, {session_id: data for session_id, data in
+                            dirty.items() if data is not None})
+        _delete_many(self.l2, [session_id for session_id, data in
+                               dirty.items() if data is None])
+
+        if self.invalidator is not None:
+            # the others may have read the old one from L2 meanwhile
+            for session_id in dirty:
+                self.invalidator.publish(session_id)
+
+    def scan(self, expires_after=None, expires_before=None, logged_in=None):
+        """Yields ``(session_id, expires, data)`` from L2, with the changes
+        that are not yet flushed. See ``FileStore.scan()``.
+        """
+        low = now() if expires_after is None else expires_after
+        high = 0xffffffff if expires_before is None else expires_before
+
+        with self._lock:
+            dirty = dict(self._dirty)
+
+        for session_id, data in dirty.items():
+            try:
+                expires = get_exp_time(session_id)
+            except ValueError:
+                continue
+
+            if (data is None or not low <= expires <= high or
+                    (logged_in is not None and
+                     bool(data.get('sid')) != logged_in)):
+                continue
+
+            yield session_id, expires, data
+
+        for item in self.l2.scan(expires_after=low, expires_before=high,
+                                 logged_in=logged_in):
+            if item[0] not in dirty:
+                yield item
+
+    def filepath(self, session_id):
+        if hasattr(self.l2, 'filepath'):
+            return self.l2.filepath(session_id)
+
+    def version(self, session_id):
+        return self.l2.version(session_id)
+
+    def exists(self, session_id):
+        if self.l1.exists(session_id):
+            return True
+
+        with self._lock:
+            if session_id in self._dirty:
+                return self._dirty[session_id] is not None
+
+        return self.l2.exists(session_id)
+
+    def get_auth(self, session_id):
+        data = self.get_cached(session_id)
+
+        if data is None:
+            if not hasattr(self.l2, 'get_auth'):
+                return self.get(session_id)
+
+            with self._lock:
+                if session_id in self._dirty:
+                    data = self._dirty[session_id]
+                else:
+                    return self.l2.get_auth(session_id)
+
+            if data is None:
+                return
+
+        if 'sid' in data:
+            return {'sid': data['sid']}
+
+        return {}
+
+    def _generation(self, session_id):
+        if self.invalidator is not None:
+            return self.invalidator.generation(session_id)
+
+    def get_cached(self, session_id):
+        """Looks up L1 without touching L2."""
+        data = self.l1.get(session_id)
+
+        if data is not None:
+            self.hits += 1
+
+        return data
+
+    def get(self, session_id):
+        data = self.get_cached(session_id)
+
+        if data is not None:
+            return data
+
+        with self._lock:
+            if session_id in self._dirty:
+                # evicted or deleted from L1, but not yet flushed.
+                # a copy, the caller may change it
+                return deepcopy(self._dirty[session_id])
+
+        self.misses += 1
+        generation = self._generation(session_id)
+        data = self.l2.get(session_id)
+
+        # not if another worker has changed it while it was being read,
+        # that change has already been evicted from L1
+        if data is not None and self._generation(session_id) == generation:
+            # promote
+            self.l1.set(session_id, data)
+
+        return data
+
+    def get_many(self, session_ids):
+        """See ``FileStore.get_many()``. The L1 misses are read from L2
+        in one batch.
+        """
+        items = {}
+        missing = []
+
+        for session_id in session_ids:
+            data = self.get_cached(session_id)
+
+            if data is not None:
+                items[session_id] = data
+                continue
+
+            with self._lock:
+                if session_id in self._dirty:
+                    data = self._dirty[session_id]
+
+                    if data is not None:
+                        items[session_id] = deepcopy(data)
+
+                    continue
+
+            missing.append(session_id)
+
+        if missing:
+            self.misses += len(missing)
+            generations = [self._generation(session_id)
+                           for session_id in missing]
+            found = _get_many(self.l2, missing)
+
+            for session_id, generation in zip(missing, generations):
+                if session_id not in found:
+                    continue
+
+                items[session_id] = found[session_id]
+
+                # see get()
+                if self._generation(session_id) == generation:
+                    self.l1.set(session_id, found[session_id])  # promote
+
+        return items
+
+    def set_many(self, items):
+        """See ``FileStore.set_many()``."""
+        items = dict(items)
+
+        for session_id, data in items.items():
+            self.l1.set(session_id, data)
+
+        if self.write_policy == 'write-through':
+            _set_many(self.l2, items)
+        else:
+            with self._lock:
+                for session_id, data in items.items():
+                    self._dirty[session_id] = dict(data)
+
+        if self.invalidator is not None:
+            for session_id in items:
+                self.invalidator.publish(session_id)
+
+    def delete_many(self, session_ids):
+        """See ``FileStore.delete_many()``."""
+        session_ids = set(session_ids)
+        deleted = {session_id for session_id in session_ids
+                   if self.l1.delete(session_id)}
+
+        if self.write_policy == 'write-through':
+            # L2 has them all
+            deleted = _delete_many(self.l2, session_ids)
+        else:
+            with self._lock:
+                for session_id in session_ids:
+                    # not yet flushed
+                    if self._dirty.get(session_id) is not None:
+                        deleted.add(session_id)
+
+                    self._dirty[session_id] = None
+
+            deleted = sum(session_id in deleted or
+                          self.l2.exists(session_id)
+                          for session_id in session_ids)
+
+        if self.invalidator is not None:
+            for session_id in session_ids:
+                self.invalidator.publish(session_id)
+
+        return deleted
+
+    def set(self, session_id, data):
+        self.l1.set(session_id, data)
+
+        if self.write_policy == 'write-through':
+            self.l2.set(session_id, data)
+        else:
+            with self._lock:
+                self._dirty[session_id] = dict(data)
+
+        if self.invalidator is not None:
+            self.invalidator.publish(session_id)
+
+    def update(self, session_id, data, changed, removed):
+        if (self.write_policy == 'write-back' or
+                not hasattr(self.l2, 'update')):
+            self.set(session_id, data)
+            return
+
+        self.l1.set(session_id, data)
+        self.l2.update(session_id, data, changed, removed)
+
+        if self.invalidator is not None:
+            self.invalidator.publish(session_id)
+
+    def compare_and_set(self, session_id, data, version, changed=None,
+                        removed=None):
+        """See ``FileStore.compare_and_set()``. The version is the one
+        of L2. With ``'write-back'``, the last writer still wins.
+        """
+        if (self.write_policy == 'write-back' or
+                not hasattr(self.l2, 'compare_and_set')):
+            self.set(session_id, data)
+            return self.version(session_id)
+
+        version = self.l2.compare_and_set(session_id, data, version,
+                                          changed, removed)
+
+        if version is None:
+            # L1 may hold the one that has been replaced
+            self.l1.delete(session_id)
+            return
+
+        self.l1.set(session_id, data)
+
+        if self.invalidator is not None:
+            self.invalidator.publish(session_id)
+
+        return version
+
+    def delete(self, session_id):
+        deleted = self.l1.delete(session_id)
+
+        if self.write_policy == 'write-through':
+            deleted = self.l2.delete(session_id) or deleted
+        else:
+            with self._lock:
+                # not yet flushed
+                deleted = self._dirty.get(session_id) is not None or deleted
+                self._dirty[session_id] = None
+
+            deleted = deleted or self.l2.exists(session_id)
+
+        if self.invalidator is not None:
+            self.invalidator.publish(session_id)
+
+        return deleted
+
+
+class SocketStore:
+    """A client of the session daemon (``tremolo_login.daemon``), over a
+    Unix domain socket. It keeps a pool of up to ``pool_size`` connections,
+    which are shared by the event loop and the worker threads.
+    """
+
+    blocking = True
+
+    def __init__(self, path, pool_size=8, timeout=5):
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def __getstate__(self):
+        # see MemoryStore.__getstate__(). the connections are not shared
+        # between the processes either, each worker opens its own
+        state = self.__dict__.copy()
+        del state['_pool']
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pool = queue.LifoQueue(maxsize=self.pool_size)
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+
+        return sock
+
+    def _recv(self, sock, size):
+        buf = bytearray()
+
+        while len(buf) < size:
+            data = sock.recv(size - len(buf))
+
+            if not data:
+                raise ConnectionResetError('connection closed by the daemon')
+
+            buf.extend(data)
+
+        return buf
+
+    def execute(self, commands):
+        """Sends a batch of ``(op, key, value)`` commands in one round-trip.
+        Returns the list of ``(status, value)`` replies.
+        """
+        frame = protocol.pack_commands(commands)
+
+        try:
+            sock = self._pool.get_nowait()
+        except queue.Empty:
+            sock = self._connect()
+
+        try:
+            try:
+                sock.sendall(frame)
+                header = self._recv(sock, protocol.FRAME.size)
+            except OSError:
+                # the pooled connection may have gone stale, retry once
+                sock.close()
+                sock = self._connect()
+                sock.sendall(frame)
+                header = self._recv(sock, protocol.FRAME.size)
+
+            size, = protocol.FRAME.unpack(header)
+            replies = list(protocol.unpack_replies(self._recv(sock, size)))
+        except BaseException:
+            sock.close()
+            raise
+
+        try:
+            self._pool.put_nowait(sock)
+        except queue.Full:
+            sock.close()
+
+        return replies
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    async def stop(self, **_):
+        self.close()
+
+    def version(self, session_id):
+        (status, value), = self.execute(
+            ((protocol.OP_VERSION, session_id, b''),)
+        )
+
+        if status == protocol.STATUS_OK:
+            return int(value)
+
+    def exists(self, session_id):
+        (status, _), = self.execute(((protocol.OP_EXISTS, session_id, b''),))
+        return status == protocol.STATUS_OK
+
+    def get(self, session_id):
+        (status, value), = self.execute(((protocol.OP_GET, session_id, b''),))
+
+        if status == protocol.STATUS_OK:
+            return json.loads(value)
+
+    def set(self, session_id, data):
+        (status, value), = self.execute(
+            ((protocol.OP_SET, session_id, json.dumps(data).encode()),)
+        )
+
+        if status == protocol.STATUS_ERROR:
+            raise ValueError(value.decode())
+
+    def delete(self, session_id):
+        (status, _), = self.execute(((protocol.OP_DELETE, session_id, b''),))
+        return status == protocol.STATUS_OK
+
+    def _execute_many(self, commands):
+        # one round-trip, unless the frame would be too large for the daemon
+        replies = []
+        batch = []
+        size = 0
+
+        for command in commands:
+            if batch and size + len(command[2]) > protocol.MAX_FRAME_SIZE // 2:
+                replies.extend(self.execute(batch))
+                batch = []
+                size = 0
+
+            batch.append(command)
+            size += len(command[1]) + len(command[2]) + 6
+
+        if batch:
+            replies.extend(self.execute(batch))
+
+        return replies
+
+    def get_many(self, session_ids):
+        """See ``FileStore.get_many()``. The sessions are read
+        in one round-trip.
+        """
+        session_ids = list(session_ids)
+        replies = self._execute_many(
+            (protocol.OP_GET, session_id, b'') for session_id in session_ids
+        )
+
+        return {session_id: json.loads(value) for session_id, (status, value)
+                in zip(session_ids, replies) if status == protocol.STATUS_OK}
+
+    def set_many(self, items):
+        """See ``FileStore.set_many()``. The sessions are written
+        in one round-trip.
+        """
+        for status, value in self._execute_many(
+                (protocol.OP_SET, session_id, json.dumps(data).encode())
+                for session_id, data in dict(items).items()):
+            if status == protocol.STATUS_ERROR:
+                raise ValueError(value.decode())
+
+    def delete_many(self, session_ids):
+        """See ``FileStore.delete_many()``. The sessions are deleted
+        in one round-trip.
+        """
+        return sum(status == protocol.STATUS_OK for status, _ in
+                   self._execute_many((protocol.OP_DELETE, session_id, b'')
+                                      for session_id in set(session_ids)))
+
+
+class BoundedStore:
+    """Limits the sessions in another store.
+
+    The number of sessions and their sizes (as JSON) are tracked as they
+    are written and deleted. The sessions that are already in the store
+    are counted once when the worker starts, if it provides ``sizes()``
+    or ``scan()``. The sizes of the existing ``FileStore`` sessions are
+    those of the files.
+    With multiple workers, each one only knows about its own writes
+    besides those, so the limits are approximate.
+
+    :param store: E.g. ``FileStore('/path/to/dir')``
+    :param max_payload: The maximum size of a session, in bytes.
+        Larger ones raise ``PayloadTooLarge``
+    :param max_sessions: The maximum number of sessions
+    :param max_bytes: The maximum size of all sessions, in bytes
+    :param policy: What to do when ``max_sessions`` or ``max_bytes``
+        is reached. ``'reject'`` raises ``ServiceUnavailable``,
+        ``'evict'`` deletes the sessions that expire the soonest,
+        ``'refuse-anonymous'`` only raises ``ServiceUnavailable``
+        for new sessions that are not logged in.
+    """
+
+    def __init__(self, store, max_payload=None, max_sessions=None,
+                 max_bytes=None, policy='reject'):
+        if policy not in ('reject', 'evict', 'refuse-anonymous'):
+            raise ValueError('policy must be one of "reject", "evict" or '
+                             '"refuse-anonymous"')
+
+        self.store = store
+        self.max_payload = max_payload
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.size = 0
+
+        self._sizes = {}
+        self._expiry = []  # (expires, session_id), stale ones are skipped
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # see MemoryStore.__getstate__()
+        state = self.__dict__.copy()
+        del state['_lock']
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name == 'store':
+            raise AttributeError(name)
+
+        # blocking, filepath, get_auth, scan, etc. of the wrapped store
+        return getattr(self.store, name)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def _add(self, session_id, expires, size):
+        if session_id in self._sizes:
+            self.size += size - self._sizes[session_id][1]
+        else:
+            self.size += size
+            heapq.heappush(self._expiry, (expires, session_id))
+
+            if len(self._expiry) > 2 * len(self._sizes) + 64:
+                # too many deleted ones left
+                self._expiry = [(v[0], k) for k, v in self._sizes.items()]
+                self._expiry.append((expires, session_id))
+                heapq.heapify(self._expiry)
+
+        self._sizes[session_id] = (expires, size)
+
+    def _remove(self, session_id):
+        entry = self._sizes.pop(session_id, None)
+
+        if entry is not None:
+            self.size -= entry[1]
+
+    def _is_live(self, expires, session_id):
+        # not deleted or rewritten since it was pushed
+        return (session_id in self._sizes and
+                self._sizes[session_id][0] == expires)
+
+    def _pop_soonest(self, exclude):
+        # the session that expires the soonest, except ``exclude``
+        excluded = None
+
+        try:
+            while self._expiry:
+                expires, session_id = heapq.heappop(self._expiry)
+
+                if not self._is_live(expires, session_id):
+                    continue
+
+                if session_id == exclude:
+                    excluded = (expires, session_id)
+                    continue
+
+                self._remove(session_id)
+                return session_id
+        finally:
+            if excluded is not None:
+                heapq.heappush(self._expiry, excluded)
+
+    def _is_full(self, sessions, size):
+        return ((self.max_sessions is not None and
+                 sessions > self.max_sessions) or
+                (self.max_bytes is not None and size > self.max_bytes))
+
+    async def start(self, globals=None, loop=None, logger=None, **_):
+        if hasattr(self.store, 'start'):
+            await self.store.start(globals=globals, loop=loop, logger=logger)
+
+        if hasattr(self.store, 'sizes') or hasattr(self.store, 'scan'):
+            executor = getattr(globals, 'executor', None)
+
+            if executor is None or not self.store.blocking:
+                self.count()
+            else:
+                await executor.submit(self.count)
+
+    async def stop(self, **_):
+        if hasattr(self.store, 'stop'):
+            await self.store.stop()
+
+    def count(self):
+        """Counts the sessions that are in the store.
+        Returns the number of them.
+        """
+        if hasattr(self.store, 'sizes'):
+            # no need to read and decode each session
+            items = self.store.sizes()
+        else:
+            items = ((session_id, expires, len(json.dumps(data)))
+                     for session_id, expires, data in self.store.scan())
+
+        for session_id, expires, size in items:
+            with self._lock:
+                self._add(session_id, expires, size)
+
+        return len(self._sizes)
+
+    def get(self, session_id):
+        data = self.store.get(session_id)
+
+        if data is None and session_id in self._sizes:
+            with self._lock:
+                self._remove(session_id)  # expired
+
+        return data
+
+    def set(self, session_id, data):
+        self._admit(session_id, data)
+        self.store.set(session_id, data)
+
+    def compare_and_set(self, session_id, data, version, changed=None,
+                        removed=None):
+        self._admit(session_id, data)
+
+        if hasattr(self.store, 'compare_and_set'):
+            return self.store.compare_and_set(session_id, data, version,
+                                              changed, removed)
+
+        self.store.set(session_id, data)
+        return self.store.version(session_id)
+
+    def get_many(self, session_ids):
+        session_ids = list(session_ids)
+        items = _get_many(self.store, session_ids)
+
+        with self._lock:
+            for session_id in session_ids:
+                if session_id not in items:
+                    self._remove(session_id)  # expired
+
+        return items
+
+    def set_many(self, items):
+        items = dict(items)
+
+        for session_id, data in items.items():
+            self._admit(session_id, data)
+
+        _set_many(self.store, items)
+
+    def delete_many(self, session_ids):
+        session_ids = set(session_ids)
+
+        with self._lock:
+            for session_id in session_ids:
+                self._remove(session_id)
+
+        return _delete_many(self.store, session_ids)
+
+    def update(self, session_id, data, changed, removed):
+        self._admit(session_id, data)
+
+        if hasattr(self.store, 'update'):
+            self.store.update(session_id, data, changed, removed)
+        else:
+            self.store.set(session_id, data)
+
+    def _admit(self, session_id, data):
+        if self.max_payload is not None or self.max_bytes is not None:
+            size = len(json.dumps(data))
+        else:
+            size = 0
+
+        if self.max_payload is not None and size > self.max_payload:
+            raise PayloadTooLarge('session is larger than %d bytes' %
+                                  self.max_payload)
+
+        expires = get_exp_time(session_id)
+        evicted = []
+
+        try:
+            with self._lock:
+                # the expired sessions go first, whatever the policy
+                timestamp = now()
+
+                while self._expiry and self._expiry[0][0] < timestamp:
+                    soonest, victim = heapq.heappop(self._expiry)
+
+                    if self._is_live(soonest, victim):
+                        self._remove(victim)
+                        evicted.append(victim)
+
+                is_new = session_id not in self._sizes
+                old_size = 0 if is_new else self._sizes[session_id][1]
+
+                while self._is_full(len(self._sizes) + is_new,
+                                    self.size - old_size + size):
+                    if self.policy == 'evict':
+                        victim = self._pop_soonest(session_id)
+
+                        if victim is not None:
+                            evicted.append(victim)
+                            continue
+
+                    if self.policy == 'refuse-anonymous' and (
+                            not is_new or data.get('sid')):
+                        break
+
+                    raise ServiceUnavailable('session store is full')
+
+                self._add(session_id, expires, size)
+        finally:
+            for victim in evicted:
+                if victim is not None:
+                    self.store.delete(victim)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._remove(session_id)
+
+        return self.store.delete(session_id)
@@ -0,0 +1,93 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2026 Anggit Arfanto
+
+import json
+import logging
+import traceback
+
+from time import perf_counter
+
+__all__ = ['SlowLog']
+
+
+def redact(session_id):
+    # the first 8 characters are the expiration time and the port/pid
+    # prefix of the id, they are not the random part
+    return '%s...' % (session_id or '')[:8]
+
+
+class Trace:
+    __slots__ = ('slow_log', 'started', 'last', 'phases')
+
+    def __init__(self, slow_log):
+        self.slow_log = slow_log
+        self.started = self.last = perf_counter()
+        self.phases = []
+
+    def mark(self, phase):
+        timestamp = perf_counter()
+        self.phases.append((phase, timestamp - self.last))
+        self.last = timestamp
+
+    def finish(self, operation, session_id, data=None):
+        elapsed = perf_counter() - self.started
+
+        if elapsed >= self.slow_log.threshold:
+            self.slow_log.log(operation, elapsed, session_id, data,
+                              self.phases)
+
+
+class NullTrace:
+    __slots__ = ()
+
+    def mark(self, phase):
+        pass
+
+    def finish(self, operation, session_id, data=None):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class SlowLog:
+    """Logs the session operations that take longer than ``threshold``
+    seconds, with their phase timings.
+
+    :param threshold: In seconds
+    :param logger: Defaults to ``logging.getLogger('tremolo_login')``
+    :param stack: Also log the stack where the slow operation finished
+    :param stack_limit: The maximum number of stack frames to log
+    """
+
+    def __init__(self, threshold=0.1, logger=None, stack=False,
+                 stack_limit=8):
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger('tremolo_login')
+        self.stack = stack
+        self.stack_limit = stack_limit
+
+    def start(self):
+        return Trace(self)
+
+    def log(self, operation, elapsed, session_id, data, phases):
+        # the payload size is only computed for the slow ones
+        try:
+            size = len(json.dumps(data)) if data is not None else 0
+        except (TypeError, ValueError):
+            size = -1
+
+        message = 'slow session %s: %.2fms, id=%s, size=%d, phases=%s' % (
+            operation,
+            elapsed * 1000,
+            redact(session_id),
+            size,
+            ', '.join('%s:%.2fms' % (name, t * 1000) for name, t in phases)
+        )
+
+        if self.stack:
+            message += '\n' + ''.join(
+                traceback.format_stack(limit=self.stack_limit + 2)[:-2]
+            )
+
+        self.logger.warning(message)
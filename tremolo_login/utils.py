@@ -0,0 +1,18 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2023 Anggit Arfanto
+
+import time
+
+from base64 import b64decode
+
+
+def now():
+    return int(time.time()) & 0xffffffff
+
+
+def get_exp_time(session_id):
+    """The first 4 bytes of the raw `session_id` is the expiration time."""
+    return int.from_bytes(
+        b64decode(session_id, altchars=b'-_', validate=True)[:4],
+        byteorder='big'
+    )